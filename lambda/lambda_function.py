@@ -1,113 +1,129 @@
 import json
+import concurrent.futures
+import textwrap
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-def lambda_handler(event, context):
-    SENDER = 'opensync@windsockmgmt.com'
-
-    RECIPIENT = 'opensync@windsockmgmt.com'
-    
-    DESTINATION = {
-        'ToAddresses': [
-            RECIPIENT,
-        ],
-    }
-    
-    AWS_REGION = "us-east-1"
-    
-    for record in event.get("Records", []):
-        body = record.get("body")
-        if body is None:
-            print("Record contained no body!")
-            continue
-        
-        try:
-            note = json.loads(body)
-            flight_summary = note.get("body")
-            
-            if flight_summary is None:
-                raise ValueError("Record contained no flight summary!")
-            
-            print(f"OpenSync Flight Log {flight_summary['beg_time']} : {flight_summary.get('origin', '')} > {flight_summary.get('destination', '')}")
-            SUBJECT = f"OpenSync Flight Log {flight_summary['beg_time']} : {flight_summary.get('origin', '')} > {flight_summary.get('destination', '')}" 
-            
-            # The HTML body of the email.
-        
-            BODY_HTML = f"""
+# orjson is used when it's bundled with the deployment package, otherwise
+# fallback to the standard library json
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+SENDER = 'opensync@windsockmgmt.com'
+
+RECIPIENT = 'opensync@windsockmgmt.com'
+
+DESTINATION = {
+    'ToAddresses': [
+        RECIPIENT,
+    ],
+}
+
+AWS_REGION = "us-east-1"
+
+# The character encoding for the email.
+CHARSET = "UTF-8"
+
+# The number of emails sent concurrently
+SEND_WORKERS = 10
+
+# Create the SES client once per execution environment so that warm
+# invocations reuse it instead of re-resolving credentials and endpoints,
+# keep-alive lets the pooled connection be reused across send_email calls
+SES = boto3.client(
+    'ses',
+    region_name=AWS_REGION,
+    config=Config(
+        tcp_keepalive=True,
+        max_pool_connections=SEND_WORKERS
+    )
+)
+
+# SQS delivers at most 10 records per batch by default, send them in parallel
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=SEND_WORKERS)
+
+# The HTML body of the emails, these are built once at import and only
+# filled in with the values of each record.  The source indentation is
+# stripped up front so it isn't formatted and sent with every email.
+FLIGHT_LOG_HTML = textwrap.dedent("""
             <body>
                 <h2>Flight Log</h2>
                 <dl>
                     <dt>Origin</dt>
-                    <dd>{flight_summary.get('origin', '')}</dd>
+                    <dd>{origin}</dd>
                     <dt>Destination</dt>
-                    <dd>{flight_summary.get('destination', '')}</dd>
+                    <dd>{destination}</dd>
                     <dt>Hobbs Time</dt>
-                    <dd>{flight_summary['hobbs_time']:.1f}</dd>
+                    <dd>{flight_summary[hobbs_time]:.1f}</dd>
                     <dt>Flight Time</dt>
-                    <dd>{flight_summary['flight_time']:.1f}</dd>
+                    <dd>{flight_summary[flight_time]:.1f}</dd>
                     <dt>Fuel Consumed</dt>
-                    <dd>{flight_summary['fuel_consumed']:.1f}</dd>
+                    <dd>{flight_summary[fuel_consumed]:.1f}</dd>
                     <dt>Fuel Remaining</dt>
-                    <dd>{flight_summary['fuel_remaining']:.1f}</dd>
+                    <dd>{flight_summary[fuel_remaining]:.1f}</dd>
                 </dl>
                 
                 <h2>Engine</h2>
                 <dl>
                     <dt>Max CHT</dt>
-                    <dd>{flight_summary['max_cht']}</dd>
+                    <dd>{flight_summary[max_cht]}</dd>
                     <dt>Max EGT</dt>
-                    <dd>{flight_summary['max_egt']}</dd>
+                    <dd>{flight_summary[max_egt]}</dd>
                     <dt>Max TIT</dt>
-                    <dd>{flight_summary['max_tit']}</dd>
+                    <dd>{flight_summary[max_tit]}</dd>
                     <dt>Max Oil Temp</dt>
-                    <dd>{flight_summary['max_oil_temp']:.0f}</dd>
+                    <dd>{flight_summary[max_oil_temp]:.0f}</dd>
                     <dt>Max Oil Pressure</dt>
-                    <dd>{flight_summary['max_oil_pressure']:.1f}</dd>
+                    <dd>{flight_summary[max_oil_pressure]:.1f}</dd>
                     <dt>Max Manifold Pressure</dt>
-                    <dd>{flight_summary['max_manifold_pressure']:.1f}</dd>
+                    <dd>{flight_summary[max_manifold_pressure]:.1f}</dd>
                     <dt>Max RPM</dt>
-                    <dd>{flight_summary['max_rpm']:.0f}</dd>
+                    <dd>{flight_summary[max_rpm]:.0f}</dd>
                 </dl>
                 
                 <h2>Battery</h2>
                 <dl>
                     <dt>Max Bat1 V</dt>
-                    <dd>{flight_summary['min_bat1_volts']:.1f}</dd>
+                    <dd>{flight_summary[min_bat1_volts]:.1f}</dd>
                     <dt>Max Bat2 V</dt>
-                    <dd>{flight_summary['min_bat2_volts']:.1f}</dd>
+                    <dd>{flight_summary[min_bat2_volts]:.1f}</dd>
                     <dt>Max Bat1 Amps</dt>
-                    <dd>{flight_summary['max_bat1_amps']:.1f}</dd> 
+                    <dd>{flight_summary[max_bat1_amps]:.1f}</dd> 
                 </dl>
                 
                 <h2>Performance</h2>
                 <dl>
                     <dt>Max IAS</dt>
-                    <dd>{flight_summary['max_ias']:.1f}</dd>
+                    <dd>{flight_summary[max_ias]:.1f}</dd>
                     <dt>Max TAS</dt>
-                    <dd>{flight_summary['max_tas']:.1f}</dd>
+                    <dd>{flight_summary[max_tas]:.1f}</dd>
                     <dt>Max Lateral Accel</dt>
-                    <dd>{flight_summary['max_lat_accel']:.1f}</dd> 
+                    <dd>{flight_summary[max_lat_accel]:.1f}</dd> 
                     <dt>Max Norm Accel</dt>
-                    <dd>{flight_summary['max_norm_accel']:.1f}</dd>
+                    <dd>{flight_summary[max_norm_accel]:.1f}</dd>
                 </dl>
                 
                 <h2>Diagnostics</h2>
                 <dl>
                     <dt>Tower Country</dt>
-                    <dd>{note['tower_country']}</dd>
+                    <dd>{note[tower_country]}</dd>
                     <dt>Tower Location</dt>
-                    <dd>{note['tower_location']}</dd>
+                    <dd>{note[tower_location]}</dd>
                 </dl>
                 <pre>
                 {body}
                 </pre>
             </body>
-            """
-        except Exception as e:
-            print(e)
-            SUBJECT = "OpenSync Flight Log Failure"
-            
-            BODY_HTML = f"""
+""").strip()
+
+FAILURE_HTML = textwrap.dedent("""
             <body>
             Failed to process flight log.
             <pre>
@@ -117,44 +133,87 @@ def lambda_handler(event, context):
                 {body}
             </pre>
             </body>
-            """
-        
-        # The character encoding for the email.
-        CHARSET = "UTF-8"
-        
-        # Create a new SES resource and specify a region.
-        client = boto3.client('ses', region_name=AWS_REGION)
-        
-        # Try to send the email.
-        response = ""
-        try:
-            #Provide the contents of the email.
-            response = client.send_email(
-                Destination = DESTINATION,
-                Message={
-                    'Body': {
-                        'Html': {
-                            'Charset': CHARSET,
-                            'Data': BODY_HTML,
-                        },
-                    },
-                    'Subject': {
+""").strip()
+
+def send_email(message):
+    message_id, SUBJECT, BODY_HTML = message
+    # Try to send the email.
+    try:
+        #Provide the contents of the email.
+        response = SES.send_email(
+            Destination = DESTINATION,
+            Message={
+                'Body': {
+                    'Html': {
                         'Charset': CHARSET,
-                        'Data': SUBJECT,
+                        'Data': BODY_HTML,
                     },
                 },
-                Source=SENDER,
-    
-            )
-        # Display an error if something goes wrong.	
-        except ClientError as e:
-            print(e.response['Error']['Message'])
-        else:
-            print("Email sent! Message ID:")
-            print(response['MessageId'])
-            print(RECIPIENT)
+                'Subject': {
+                    'Charset': CHARSET,
+                    'Data': SUBJECT,
+                },
+            },
+            Source=SENDER,
+
+        )
+    # Display an error if something goes wrong.	
+    except ClientError as e:
+        print(e.response['Error']['Message'])
+        return {'messageId': message_id, 'error': e.response['Error']['Message']}
+    else:
+        print("Email sent! Message ID:")
+        print(response['MessageId'])
+        print(RECIPIENT)
+        return {'messageId': message_id, 'emailMessageId': response['MessageId']}
+
+def lambda_handler(event, context):
+    messages = []
+    for record in event.get("Records", []):
+        body = record.get("body")
+        if body is None:
+            print("Record contained no body!")
+            continue
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps(response)
-        }
\ No newline at end of file
+        try:
+            note = json_loads(body)
+            flight_summary = note.get("body")
+            
+            if flight_summary is None:
+                raise ValueError("Record contained no flight summary!")
+            
+            beg_time = flight_summary['beg_time']
+            origin = flight_summary.get('origin', '')
+            destination = flight_summary.get('destination', '')
+
+            SUBJECT = f"OpenSync Flight Log {beg_time} : {origin} > {destination}"
+            print(SUBJECT)
+            
+            BODY_HTML = FLIGHT_LOG_HTML.format(
+                flight_summary=flight_summary,
+                note=note,
+                origin=origin,
+                destination=destination,
+                body=body
+            )
+        except Exception as e:
+            print(e)
+            SUBJECT = "OpenSync Flight Log Failure"
+            
+            BODY_HTML = FAILURE_HTML.format(e=e, body=body)
+
+        messages.append((record.get("messageId"), SUBJECT, BODY_HTML))
+
+    # Send the emails once every record in the batch has been rendered, so
+    # that the whole SQS batch is delivered rather than only the first record.
+    # The sends are I/O bound so they are issued concurrently.
+    results = list(POOL.map(send_email, messages))
+    failures = [ {'itemIdentifier': result['messageId']} for result in results if 'error' in result ]
+
+    # batchItemFailures is used by SQS to retry only the records that failed
+    # when the trigger has ReportBatchItemFailures enabled
+    return {
+        'statusCode': 200,
+        'body': json_dumps(results),
+        'batchItemFailures': failures
+    }
\ No newline at end of file
@@ -34,7 +34,6 @@ setuptools.setup(
     python_requires=">=3.9",
     install_requires=[
         "requests",
-        "beautifulsoup4",
         "lxml",
         "tinydb",
         "pandas",
@@ -45,4 +44,8 @@ setuptools.setup(
         "ConfigArgParse",
         "neobase"
     ],
+    extras_require={
+        # process_flight_log(..., save_parquet=True)
+        "parquet": ["pyarrow"],
+    },
 )
\ No newline at end of file
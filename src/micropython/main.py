@@ -1,39 +1,70 @@
 #!/usr/bin/env python
 
+import sys
+
+# Make sure notecard picks up the built-in C implementation of json, newer
+# MicroPython releases name it json and drop the ujson alias
+try:
+    import ujson
+    sys.modules['json'] = ujson
+except ImportError:
+    pass
+
 import notecard
 import logging
 import os
 import time
 
-import opensync
-print(opensync)
 from opensync import notecard_helpers
 
-def opensync(card, **kwargs):
-    # Print out the Notecard version
-    # req = { "req": "card.restart" }
-    # rsp = card.Transaction(req)
-    # logging.debug("Found Notecard %s", rsp)
+# GPIO wired to the Notecard ATTN pin, wake_on_ext0 requires an RTC GPIO
+# (0, 2, 4, 12-15, 25-27 or 32-39 on the ESP32)
+ATTN_PIN = 27
+# Upper bound on how long to sleep while waiting for ATTN
+ATTN_TIMEOUT_MS = 60 * 60 * 1000
+# Records the hub configuration that was last applied to the Notecard
+STATE_FILE = "/opensync.state"
 
-    time.sleep(10)
+def opensync(card, mode="continuous", heartbeat=None, **kwargs):
+    import esp32
+    import machine
 
-    # Print out the Notecard version
+    # Print out the Notecard version, retrying with backoff while the
+    # Notecard finishes booting
     req = { "req": "card.version" }
-    rsp = card.Transaction(req)
+    for attempt in range(10):
+        try:
+            rsp = card.Transaction(req)
+            break
+        except Exception as e:
+            logging.debug("Waiting for Notecard %s", e)
+            time.sleep(0.5 * (1.5 ** attempt))
+    else:
+        rsp = card.Transaction(req)
     logging.debug("Found Notecard %s", rsp)
 
-    # req = {"req": "card.wifi"}
-    # req["ssid"] = "FiOS-QJ0JA-Guest"
-    # req["password"] = "goatlamp"
-    # rsp = card.Transaction(req)
-
-    # Set minimum hub sync
+    # Set minimum hub sync, the settings persist on the Notecard so this is
+    # skipped when they were already applied for this Notecard version
     req = {"req": "hub.set"}
-    req['mode'] = "continuous"
+    req['mode'] = mode
     if kwargs.get('product'):
         req['product'] = kwargs['product']
-    rsp = card.Transaction(req)
-    logging.info("Setting minimum mode %s", rsp)
+
+    state = "%s %s %s" % (rsp.get("version"), req['mode'], req.get('product'))
+    try:
+        with open(STATE_FILE) as f:
+            cached = f.read()
+    except OSError:
+        cached = None
+
+    if state != cached:
+        rsp = card.Transaction(req)
+        logging.info("Setting minimum mode %s", rsp)
+        if "err" not in rsp:
+            with open(STATE_FILE, "w") as f:
+                f.write(state)
+    else:
+        logging.debug("Hub already configured")
 
     # Perform a sync now
     notecard_helpers.sync_and_wait(card)
@@ -52,11 +83,32 @@ def opensync(card, **kwargs):
         rsp = card.Transaction(req)
 
     try:
-        while True:
+        # With a heartbeat, post a hub.log every heartbeat seconds instead of
+        # waiting on ATTN
+        while heartbeat:
             req = { "req": "hub.log", "text": "HELLO" }
             rsp = card.Transaction(req)
             logging.debug("Found Notecard %s", rsp)
-            time.sleep(30)
+            machine.lightsleep(heartbeat * 1000)
+
+        # Wake from sleep when the Notecard raises ATTN, which it holds high
+        # once it has fired and low while it is armed
+        attn = machine.Pin(kwargs.get("attn_pin", ATTN_PIN), machine.Pin.IN)
+        esp32.wake_on_ext0(attn, esp32.WAKEUP_ANY_HIGH)
+
+        while True:
+            # Arm ATTN to fire when notes are added to the data notefile
+            req = {"req": "card.attn"}
+            req["mode"] = "arm,files"
+            req["files"] = ["data.qo"]
+            rsp = card.Transaction(req)
+            logging.debug("Armed ATTN %s", rsp)
+
+            # Sleep until ATTN fires, waking periodically in case it is missed
+            machine.lightsleep(ATTN_TIMEOUT_MS)
+            if attn.value():
+                logging.info("ATTN fired, performing hub sync")
+                notecard_helpers.sync_and_wait(card)
     finally:
         notecard_helpers.sync_and_wait(card)
     
@@ -71,10 +123,12 @@ def micropython_main():
 
     print(os.getcwd())
     print(os.listdir())
-    # Establish the I2C bus and search for notecard
-    port = machine.SoftI2C(
+    # Establish the I2C bus on the hardware peripheral and search for notecard
+    port = machine.I2C(
+        0,
         scl=machine.Pin(22),
-        sda=machine.Pin(23)
+        sda=machine.Pin(23),
+        freq=400_000
     )
     
     # Search for the Notecard
@@ -93,7 +147,6 @@ def micropython_main():
     # Connect the WiFi
     sta_if = network.WLAN(network.STA_IF)
     sta_if.active(False)
-    #sta_if.connect("ez Share", "88888888")
     
     # Execute the main
     opensync(
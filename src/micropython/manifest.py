@@ -0,0 +1,15 @@
+# Freezes the opensync helpers into a MicroPython firmware image as bytecode,
+# main.py is left on the filesystem so it can be updated without a rebuild.
+#
+#   make -C ports/esp32 BOARD=ESP32_GENERIC FROZEN_MANIFEST=/path/to/opensync/src/micropython/manifest.py
+
+include("$(PORT_DIR)/boards/manifest.py")
+
+require("logging")
+
+package(
+    "opensync",
+    files=("__init__.py", "notecard_helpers.py"),
+    base_path="..",
+    opt=3,
+)
@@ -24,11 +24,15 @@ import csv
 import datetime
 import time
 import signal
+import select
 import platform
+import tempfile
+import subprocess
 import io
 import sys
 import zoneinfo
-import pytz
+import concurrent.futures
+import functools
 
 # Pip installed imports
 import requests
@@ -63,19 +67,41 @@ except ImportError:
     I2C = None
     EXTERNAL_POWER = True
 
+# G1000 flight log file names, legacy FlashAir cards report 8.3 upper case names
+G1000_LOG_RE = re.compile(r"log_(\d+)_(\d+)_(.*)\.csv")
+G1000_LEGACY_LOG_RE = re.compile(r"LOG_(.*)\.CSV")
+
+# Notecard status requests that are only queried for debug logging
+DEBUG_STATUS_REQUESTS = (
+    {"req": "hub.status"},
+    {"req": "card.wireless"},
+    {"req": "card.voltage"},
+    {"req": "card.motion"},
+)
+
+# Query used for the flight log records in the local database
+LOG_Q = Query()
+
+# Prefix of flight logs downloaded from the SD card into the data path
+DOWNLOAD_PREFIX = "download_"
+
+# Seconds between checks of the system time against the notecard time
+TIME_CHECK_PERIOD = 600
+LAST_TIME_CHECK = None
+
+# Read end of the pipe signals are written to, so that sleeping loops
+# wake up as soon as a signal is received
+SIGNAL_WAKEUP_FD = None
+
 def check_battery_available():
     # GPIO27 UPS is on-line pin 27 toggles every 0.5 seconds
     if GPIO is not None:
-        timeout_at = time.time() + 1
-        ups_status1 = GPIO.input(27)
-        logging.info("Checking initial GPIO pin 27 %s", ups_status1)
-        while time.time() < timeout_at:
-            time.sleep(0.1)
-            ups_status2 = GPIO.input(27)
-            logging.info("Checking GPIO pin 27 %s", ups_status2)
-            if (ups_status1 != ups_status2):
-                logging.info("Detected UPS battery")
-                return True
+        # Wait up to 1 second for the pin to toggle
+        edge = GPIO.wait_for_edge(27, GPIO.BOTH, timeout=1000)
+        logging.info("Checking GPIO pin 27 %s", "toggled" if edge is not None else "not toggled")
+        if edge is not None:
+            logging.info("Detected UPS battery")
+            return True
         return False
     else:
         return True
@@ -92,22 +118,69 @@ def external_power_available():
         global EXTERNAL_POWER
         return EXTERNAL_POWER
 
+def wakeup_on_signal():
+    global SIGNAL_WAKEUP_FD
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    SIGNAL_WAKEUP_FD = wakeup_r
+
+def sleep_until(next_check):
+    # Checks are scheduled on the monotonic clock so that setting the system
+    # time from the notecard doesn't move them
+    delay = next_check - time.monotonic()
+    if delay <= 0:
+        return False
+
+    if SIGNAL_WAKEUP_FD is None:
+        time.sleep(delay)
+        return False
+
+    # Returns True if the sleep was cut short by a signal
+    readable, _, _ = select.select([SIGNAL_WAKEUP_FD], [], [], delay)
+    if readable:
+        os.read(SIGNAL_WAKEUP_FD, 512)
+        return True
+    return False
+
+def flight_log_size(flight_log):
+    # Flight logs are either the downloaded contents or an open file
+    if isinstance(flight_log, str):
+        return len(flight_log)
+    return os.fstat(flight_log.fileno()).st_size
+
+def rewind_flight_log(flight_log):
+    if isinstance(flight_log, str):
+        return io.StringIO(flight_log)
+    flight_log.seek(0)
+    return flight_log
+
+def download_flight_log(sdcard, download_fname, data_path):
+    # Downloaded flight logs are kept in the data path rather than in memory
+    with tempfile.NamedTemporaryFile(dir=data_path, prefix=DOWNLOAD_PREFIX, suffix=".csv", delete=False) as f:
+        try:
+            sdcard.download(download_fname, f)
+        except:
+            f.close()
+            os.unlink(f.name)
+            raise
+    return f.name
+
+def discard_download(flight_log_path):
+    if flight_log_path is not None:
+        try:
+            os.unlink(flight_log_path)
+        except FileNotFoundError:
+            pass
+
 def peek_flight_log(cfg, db, fname, flight_log):
     airframe_info, flight_log_df = g1000.parse_flight_log(flight_log)
 
     summary = {}
 
-    beg_time = datetime.datetime.combine(
-        flight_log_df.iloc[0]['Lcl Date'].date(),
-        flight_log_df.iloc[0]['Lcl Time'].time(),
-        flight_log_df.iloc[0]['UTCOfst']
-    )
-
-    end_time = datetime.datetime.combine(
-        flight_log_df.iloc[-1]['Lcl Date'].date(),
-        flight_log_df.iloc[-1]['Lcl Time'].time(),
-        flight_log_df.iloc[-1]['UTCOfst']
-    )
+    # Lcl Time already carries the date and UTC offset
+    beg_time = flight_log_df['Lcl Time'].iloc[0]
+    end_time = flight_log_df['Lcl Time'].iloc[-1]
 
     summary['beg_time'] = beg_time.isoformat()
 
@@ -115,27 +188,25 @@ def peek_flight_log(cfg, db, fname, flight_log):
 
     summary['duration'] = ( end_time - beg_time )
 
-    summary['engine_still_running'] = bool( flight_log_df.iloc[-1]['E1 RPM'] > 500)
-    summary['final_ias'] = flight_log_df.iloc[-1]['IAS']
-    summary['final_alt'] = flight_log_df.iloc[-1]['AltMSL']
+    summary['engine_still_running'] = bool( flight_log_df['E1 RPM'].iloc[-1] > 500)
+    summary['final_ias'] = flight_log_df['IAS'].iloc[-1]
+    summary['final_alt'] = flight_log_df['AltMSL'].iloc[-1]
 
     return summary
 
-def process_flight_log(cfg, db, fname, flight_log, save_pkl=False):
+def process_flight_log(cfg, db, fname, flight_log, save_parquet=False):
     logging.info("Processing flight log %s", fname)
-    flight_log_metadata = re.match("log_(\d+)_(\d+)_(.*).csv", os.path.basename(fname))
+    if flight_log is None:
+        return None
 
     bfname = os.path.basename(fname)
+    flight_log_metadata = G1000_LOG_RE.match(bfname)
 
-    if flight_log is None:
-        return None
-        
-    airframe_info, flight_log_df = g1000.parse_flight_log(flight_log)
+    airframe_info, flight_log_df = g1000.parse_flight_log(rewind_flight_log(flight_log))
     
-    dname = os.path.splitext(bfname)[0] + ".pkl"
     dpath = os.path.join(
         cfg["data_path"], 
-        dname
+        os.path.splitext(bfname)[0] + ".parquet"
     )
 
     if not flight_log_metadata:
@@ -153,14 +224,18 @@ def process_flight_log(cfg, db, fname, flight_log, save_pkl=False):
     record = {
         'type': 'log',
         'fname': bfname,
-        'datapath': dpath,
+        # only set when the parquet copy is actually written
+        'datapath': dpath if save_parquet else None,
         'origin': origin,
         'flight_log_summary': flight_log_summary,
-        'size': len(flight_log)
+        'size': flight_log_size(flight_log)
     }
     
-    if save_pkl:
-        flight_log_df.to_pickle(dpath)
+    # Requires pyarrow (the opensync[parquet] extra), the UTC offset is
+    # stored as text because parquet has no type for timezone objects (Lcl
+    # Time retains the offset)
+    if save_parquet:
+        flight_log_df.astype({'UTCOfst': str}).to_parquet(dpath, compression='zstd')
 
     return record
 
@@ -176,26 +251,25 @@ def report_flight(nCard, db, record, flight_log, **kwargs):
 
     flight_log_summary = record.get('flight_log_summary')
 
-    if not flight_log:
+    if not flight_log or flight_log_size(flight_log) == 0:
         logging.debug("Not reporting, flight log is empty")
         return
 
     logging.debug("Reporting flight %s", record)
-    Q = Query()
-    result = db.search((Q.type == "log") & (Q.fname == record['fname']))
+    log_index = kwargs["log_index"]
+    reported_size = log_index.get(record['fname'])
 
     update = False
-    reported_size = 0
-    current_size = len(flight_log)
-    if len(result) > 0:
+    current_size = flight_log_size(flight_log)
+    if reported_size is not None:
         logging.info("Updating record %s:", record['fname'])
         update = True
-        reported_size = result[0].get('size', 0)
-        db.update(record, (Q.type == "log") & (Q.fname == record['fname']))
+        db.update(record, (LOG_Q.type == "log") & (LOG_Q.fname == record['fname']))
     else:
         logging.info("Inserting record %s:", record['fname'])
         reported_size = current_size
         db.insert(record)
+    log_index[record['fname']] = record.get('size', 0)
 
     # Skip reporting of zero hour flights
     if kwargs.get("report_zero_hour_flights", False) == False and flight_log_summary.get("hobbs_time", 0) < 0.05:
@@ -220,63 +294,219 @@ def report_flight(nCard, db, record, flight_log, **kwargs):
     if kwargs.get("savvy_aviation_token") and kwargs.get("disable_savvy") != True:
         if kwargs.get("savvy_full_log") is not True:
             logging.info("Pruning flight log")
-            pruned_flight_log = io.StringIO()
-            try:
-                with io.StringIO(flight_log) as inf:
-                    g1000.prune_flight_log(
-                        inf,
-                        pruned_flight_log
-                    )
-
-                savvy_flight_log = pruned_flight_log.getvalue()
-            finally:
-                pruned_flight_log.close()
+            savvy_lines = g1000.iter_prune_flight_log(rewind_flight_log(flight_log))
         else:
-            savvy_flight_log = flight_log
+            savvy_lines = rewind_flight_log(flight_log)
 
-        if nCard:
-            try:
-                with notecard_helpers.temporary_mode(nCard, "continuous", timeout=kwargs.get("savvy_aviation_timeout")):
-                    savvy.publish_flight_log_notecard(
-                        nCard,
-                        kwargs["savvy_aviation_token"],
-                        kwargs["savvy_aviation_aircraft_id"],
-                        record['fname'],
-                        savvy_flight_log
-                    ) 
-            except RuntimeError:
-                logging.exception("couldn't publish to savvy aviation")
-        else:
-            savvy.publish_flight_log_direct(
-                kwargs["savvy_aviation_token"],
-                kwargs["savvy_aviation_aircraft_id"],
-                record['fname'],
-                savvy_flight_log
-            )
+        # Spool the upload to a file which is then streamed, so that no second
+        # copy of the flight log is held in memory
+        with tempfile.TemporaryFile(dir=kwargs["data_path"]) as savvy_flight_log:
+            # The text wrapper encodes the lines in batches as they are written
+            savvy_writer = io.TextIOWrapper(savvy_flight_log, encoding="utf-8", newline="")
+            savvy_writer.writelines(savvy_lines)
+            savvy_writer.detach()
+            savvy_flight_log.seek(0)
+
+            if nCard:
+                try:
+                    with notecard_helpers.temporary_mode(nCard, "continuous", timeout=kwargs.get("savvy_aviation_timeout")):
+                        savvy.publish_flight_log_notecard(
+                            nCard,
+                            kwargs["savvy_aviation_token"],
+                            kwargs["savvy_aviation_aircraft_id"],
+                            record['fname'],
+                            savvy_flight_log,
+                            skip_mode=True
+                        ) 
+                except RuntimeError:
+                    logging.exception("couldn't publish to savvy aviation")
+            else:
+                savvy.publish_flight_log_direct(
+                    kwargs["savvy_aviation_token"],
+                    kwargs["savvy_aviation_aircraft_id"],
+                    record['fname'],
+                    savvy_flight_log
+                )
+
+def poll_loop(on_poll, battery_status, power_lost_timeout, **kwargs):
+    # Calls on_poll every poll period and returns once the external power
+    # has been lost for more than power_lost_timeout seconds
+    external_power_lost_at = None
+    next_check = time.monotonic()
+
+    while True:
+        if time.monotonic() >= next_check:
+            # Schedule the next check
+            next_check = time.monotonic() + kwargs["poll_period"]
+
+            # Check that the external power is available, if it's been turned off
+            # for too long then initiate the shutdown procedure
+            if battery_status == True and kwargs.get("disable_ups") != True:
+                power_status = external_power_available()
+                if power_status and external_power_lost_at is not None:
+                    external_power_lost_at = None
+                    logging.info("External power restored")
+                elif not power_status and external_power_lost_at is None:
+                    external_power_lost_at = time.monotonic()
+                    logging.info("External power lost")
+                elif external_power_lost_at is not None and time.monotonic() - external_power_lost_at > power_lost_timeout: # TODO make configurable via kwargs
+                    logging.info("External power lost for too long, initiating shutdown")
+                    return
+
+            on_poll()
+
+        # Sleep until the next check is due, a signal triggers a check immediately
+        if sleep_until(next_check):
+            next_check = time.monotonic()
+
+def process_flight_log_file(cfg, fpath):
+    # Runs in a worker process, so only the record is returned and the
+    # database is left to the caller
+    with open(fpath, errors="replace") as flight_log:
+        try:
+            return process_flight_log(cfg, None, fpath, flight_log)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            logging.exception("Unexpected error processing flight log %s", fpath)
+            return None
 
 def opensync_g1000_file_process(db, nCard, **kwargs):
     #############################
     # Running in offline file processing mode, primarily useful for debugging
     if len(kwargs.get("files")) == 1 and os.path.isdir(kwargs.get("files")[0]):
-        files = [ os.path.join(kwargs.get("files")[0], ff) for ff in os.listdir(kwargs.get("files")[0]) ]
+        # The directory entries cache the file name and type
+        with os.scandir(kwargs.get("files")[0]) as it:
+            files = sorted(
+                (entry.name, entry.path) for entry in it if entry.is_file()
+            )
     else:
-        files = kwargs.get("files")
-
-    for fpath in sorted(files, key=lambda x: os.path.basename(x)):
-        if os.path.isfile(fpath):
-            with open(fpath, errors="replace") as f:
-                record = None
-                flight_log = f.read()
-                try:
-                    record = process_flight_log(kwargs, db, fpath, flight_log)
-                except (SystemExit, KeyboardInterrupt):
-                    raise
-                except:
-                    logging.exception("Unexpected error processing flight log %s", fpath)
-                # If a record was created and we are connected to a notecard,
-                # send the message
+        files = sorted(
+            (os.path.basename(fpath), fpath) for fpath in kwargs.get("files") if os.path.isfile(fpath)
+        )
+
+    # Parsing the flight logs is CPU bound so they are processed in worker
+    # processes, the records are stored and reported here in order
+    fpaths = [ fpath for _, fpath in files ]
+    max_workers = max(1, (os.cpu_count() or 1) - 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        # Only the config process_flight_log reads is sent to the workers,
+        # not the whole of kwargs with its log index
+        cfg = { "data_path": kwargs["data_path"] }
+        records = pool.map(functools.partial(process_flight_log_file, cfg), fpaths, chunksize=4)
+        for fpath, record in zip(fpaths, records):
+            # If a record was created and we are connected to a notecard,
+            # send the message
+            with open(fpath, errors="replace") as flight_log:
                 report_flight(nCard, db, record, flight_log, **kwargs)
 
+def process_downloaded_flight_log(nCard, db, fname, flight_log_path, **kwargs):
+    with open(flight_log_path, errors="replace") as flight_log:
+        record = None
+        try:
+            record = process_flight_log(kwargs, db, fname, flight_log)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            logging.exception("Unexpected error processing flight log")
+
+        # If a record was created and we are connected to a notecard,
+        # send the message
+        report_flight(nCard, db, record, flight_log, **kwargs)
+    discard_download(flight_log_path)
+
+def check_card_time(nCard):
+    # Returns True once the system clock agrees with the card time
+    # Get card time
+    logging.info("Requesting card time")
+    req = {"req": "card.time"}
+    rsp = nCard.Transaction(req)
+    logging.debug("Obtained card time %s", rsp)
+    if rsp.get("zone") in (None, "UTC,Unknown") or rsp.get("time") in (None, 0, ""):
+        logging.warning("Failed to obtain card time")
+        return False
+
+    try:
+        zone = rsp["zone"].split(",", 1)[-1]
+        card_now = datetime.datetime.fromtimestamp(
+            rsp["time"],
+            zoneinfo.ZoneInfo(zone)
+        ).astimezone(datetime.timezone.utc)
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        tdelta = abs(now - card_now)
+        logging.info("Card time %s System time %s Delta %s", card_now, now, tdelta)
+        if tdelta > datetime.timedelta(seconds=30):    
+            set_time = ["sudo", "date", "-s", card_now.strftime("%Y-%m-%d %H:%M:%S")]
+            logging.debug("Setting time: %s", set_time)
+            result = subprocess.run(set_time, capture_output=True, text=True)
+            if result.returncode != 0:
+                logging.warning("Failed to set time: %s", result.stderr.strip())
+                return False
+    except:
+        logging.exception("Failed to set time")
+        return False
+
+    return True
+
+def check_notecard_status(nCard):
+    # These requests are only used for logging, so skip the round trips to
+    # the notecard unless they will be logged
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for req in DEBUG_STATUS_REQUESTS:
+            rsp = nCard.Transaction(dict(req))
+            logging.debug("%s: %s", req["req"], rsp)
+
+    req = {"req": "hub.sync.status"}
+    rsp = nCard.Transaction(req)
+    logging.debug("hub.sync.status: %s", rsp)
+    if rsp.get("sync") is True:
+        req = {"req": "hub.sync"}
+        rsp = nCard.Transaction(req)
+        logging.debug("hub.sync: %s", rsp)
+
+    # The system clock rarely drifts, so once the card time has been obtained
+    # it is only checked periodically
+    global LAST_TIME_CHECK
+    if LAST_TIME_CHECK is None or time.monotonic() - LAST_TIME_CHECK > TIME_CHECK_PERIOD:
+        if check_card_time(nCard):
+            LAST_TIME_CHECK = time.monotonic()
+
+    # Get card location
+    logging.info("Requesting card location")
+    req = {"req": "card.location"}
+    rsp = nCard.Transaction(req)
+    logging.debug("Obtained card location %s", rsp)
+
+def connect_sdcard(**kwargs):
+    sdcard = None
+    data_log_path = None
+    if kwargs.get("wifi_sdcard") == "ezshare":
+        try:
+            sdcard = ezshare.EzShare(kwargs["ezshare_url"])
+            version = sdcard.version()
+            logging.info("Connected to ezShare card: %s", version)
+            data_log_path = "A:%5Cdata_log"
+        except requests.exceptions.ConnectionError:
+            logging.info("Waiting for connection to ezShare card")
+            sdcard = None
+    elif kwargs.get("wifi_sdcard") == "flashair":
+        try:
+            sdcard = flashair.FlashAir(kwargs["flashair_url"])
+            version = sdcard.version()
+            logging.info("Connected to flashair card: %s", version)
+            data_log_path = "/data_log"
+            if version[8:10] != "W4":
+                logging.info("Using earlier version of FlashAir")
+                sdcard.legacy = True
+            else:
+                sdcard.legacy = False
+        except requests.exceptions.ConnectionError:
+            logging.info("Waiting for connection to flashAir card")
+            sdcard = None
+
+    return sdcard, data_log_path
+
 def opensync_g1000_wifi_sdcard_process(db, nCard, **kwargs):
     #############################
     # Running in WiFi SDCard Mode
@@ -289,255 +519,179 @@ def opensync_g1000_wifi_sdcard_process(db, nCard, **kwargs):
         logging.warning("No battery is available, files will not be processed on shutdown")
 
     # Variables used within the main loop
+    log_index = kwargs["log_index"]
     pending_files = {}
-    version = None
-    external_power_lost_at = None
-    shutdown = False
-    next_check = datetime.datetime.now()
     sdcard = None
+    data_log_path = None
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    # Remove any downloads left behind by a previous run, they are
+    # downloaded again from the SD card
+    with os.scandir(kwargs["data_path"]) as it:
+        for entry in it:
+            if entry.name.startswith(DOWNLOAD_PREFIX):
+                discard_download(entry.path)
+
+    # Polled every poll period until the external power is lost
+    def poll_sdcard():
+        nonlocal sdcard, data_log_path
+
+        # Check the notecard status in the background while the SD card
+        # is listed, the two are independent
+        notecard_status = None
+        if nCard:
+            notecard_status = executor.submit(check_notecard_status, nCard)
 
-    # The main loop
-    while (not shutdown):
-        
-        if datetime.datetime.now() > next_check:
-            # Schedule the next check
-            next_check = datetime.datetime.now() + datetime.timedelta(seconds=kwargs["poll_period"])
+        files = None
+        if sdcard is None:
+            sdcard, data_log_path = connect_sdcard(**kwargs)
 
-            # Check that the external power is available, if it's been turned off
-            # for more than 1 minute then initiate the shutdown procedure
-            if battery_status == True and kwargs.get("disable_ups") != True:
-                power_status = external_power_available()
-                if power_status and external_power_lost_at is not None:
-                    external_power_lost_at = None
-                    logging.info("External power restored")
-                elif not power_status and external_power_lost_at is None:
-                    external_power_lost_at = datetime.datetime.now()
-                    logging.info("External power lost")
-                elif external_power_lost_at is not None and datetime.datetime.now() - external_power_lost_at > datetime.timedelta(seconds=10): # TODO make configurable via kwargs
-                    logging.info("External power lost for too long, initiating shutdown")
-                    shutdown = True
-                    continue
-
-            if nCard:
-                # Check card connection status
-                req = {"req": "hub.status"}
-                rsp = nCard.Transaction(req)
-                logging.debug("hub.status: %s", rsp)
+        # List all the files on the SD card
+        if sdcard is not None and data_log_path is not None:
+            try:
+                files = sdcard.files(data_log_path)
+            except requests.exceptions.ConnectionError:
+                logging.info("Lost connection to sd card")
 
-                req = {"req": "hub.sync.status"}
-                rsp = nCard.Transaction(req)
-                logging.debug("hub.sync.status: %s", rsp)
-                if rsp.get("sync") is True:
-                    req = {"req": "hub.sync"}
-                    rsp = nCard.Transaction(req)
-                    logging.debug("hub.sync: %s", rsp)
+        # The notecard is also used while reporting flights so the status
+        # check needs to complete first
+        if notecard_status is not None:
+            notecard_status.result()
 
-                req = {"req": "card.wireless"}
-                rsp = nCard.Transaction(req)
-                logging.debug("card.wireless: %s", rsp)
+        if files is None:
+            return
 
-                req = {"req": "card.voltage"}
-                rsp = nCard.Transaction(req)
-                logging.debug("card.voltage: %s", rsp)
+        # Filter out to only include G1000 logs
+        if getattr(sdcard, "legacy", False) != True:
+            log_re = G1000_LOG_RE
+        else:
+            log_re = G1000_LEGACY_LOG_RE
+        files = sorted(
+            (x for x in files if log_re.match(x[1])),
+            key=lambda x: x[1]
+        )
+        logging.info("Card has %s files on it, %s files pending", len(files), len(pending_files))
+
+        # For each file currently on the SD card
+        processing = []
+        for download_fname, fname, created_at, filesize in files:
+            # Check if it's in our local database and skip processing it
+            # unless Force is true
+            processed_size = log_index.get(fname)
+
+            needs_update = False
+            
+            if filesize is None:
+                filesize = 0
 
-                req = {"req": "card.motion"}
-                rsp = nCard.Transaction(req)
-                logging.debug("card.motion: %s", rsp)
+            if processed_size is not None:
+                # TODO do we want to re-process old files?  Given the polling loop, the processed file will likey be smaller
+                # than the file currently on the SD card
+                
+                #try:
+                #    needs_update = (processed_size < int(filesize))
+                #except:
+                #    logging.exception("unexpected error comparing file sizes")
+                #    needs_update = False
+                logging.debug("Already have seen %s (%s): processed size %s current size %s", fname, needs_update, processed_size, filesize)
+            else:
+                needs_update = True
 
-                # Get card time
-                logging.info("Requesting card time")
-                req = {"req": "card.time"}
-                rsp = nCard.Transaction(req)
-                logging.debug("Obtained card time %s", rsp)
-                if rsp.get("zone") in (None, "UTC,Unknown") or rsp.get("time") in (None, 0, ""):
-                    logging.warning("Failed to obtain card time")
+            if needs_update == False and (kwargs.get("force") != True):
+                # The file is in the database and force isn't used, so skip the file
+                logging.debug("Already have processed %s", fname)
+            else:
+                # The pending files list is a set of files that we have seen, but haven't yet
+                # processed.  If a file stays the same size for two checks then it gets processed
+                # otherwise it is downloaded (since the G1000 will get powered off at the end of the flight)
+                # and stored in pending files...in practice there should be at most one pending file that
+                # has been fully download
+                flight_log_path = None
+                try:
+                    filesize = int(filesize)
+                except ValueError:
+                    logging.exception("failed to parse filesize")
+                    continue
+                if (pending_files.get(fname)) is None or filesize < 128:
+                    # If the file stays the same size it will get processed next check
+                    logging.debug("File %s is currently %s bytes", fname, filesize)
+                    discard_download(pending_files.get(fname, (None, None))[1])
+                    pending_files[fname] = (filesize, None)
+                    continue
                 else:
+                    # If the file is changing then it's the currently active log file,
+                    # download it so that when the batteries are turned off (thus cutting power
+                    # to opensync) it can be processed
+                    logging.info("Downloading %s %s", fname, download_fname)
                     try:
-                        zone = rsp["zone"].split(",", 1)[-1]
-                        tz = tzinfo=zoneinfo.ZoneInfo(zone)
-
-                        card_now = datetime.datetime.fromtimestamp(
-                            rsp["time"],
-                            tz
-                        ).astimezone(pytz.UTC)
-
-
-                        now = datetime.datetime.now().astimezone(pytz.UTC)
-                        tdelta = abs(now - card_now)
-                        logging.info("Card time %s System time %s Delta %s", card_now, now, tdelta)
-                        if tdelta > datetime.timedelta(seconds=30):    
-                            set_time = "sudo date -s '%s'" % card_now.strftime("%Y-%m-%d %H:%M:%S")
-                            logging.debug("Setting time: %s", set_time)
-                            os.system(set_time)
+                        flight_log_path = download_flight_log(sdcard, download_fname, kwargs["data_path"])
+                    except requests.exceptions.ConnectionError:
+                        logging.info("Lost connection to sd card")
+                        break
                     except:
-                        logging.exception("Failed to set time")
-    
-                # Get card location
-                logging.info("Requesting card location")
-                req = {"req": "card.location"}
-                rsp = nCard.Transaction(req)
-                logging.debug("Obtained card location %s", rsp)
+                        logging.info("Unexpected error downloading file")
+                        break
 
-            if sdcard is None:
-                if kwargs.get("wifi_sdcard") == "ezshare":
-                    try:
-                        sdcard = ezshare.EzShare(kwargs["ezshare_url"])
-                        version = sdcard.version()
-                        logging.info("Connected to ezShare card: %s", version)
-                        data_log_path = "A:%5Cdata_log"
-                    except requests.exceptions.ConnectionError:
-                        logging.info("Waiting for connection to ezShare card")
-                        sdcard = None
-                elif kwargs.get("wifi_sdcard") == "flashair":
-                    try:
-                        sdcard = flashair.FlashAir(kwargs["flashair_url"])
-                        version = sdcard.version()
-                        logging.info("Connected to flashair card: %s", version)
-                        data_log_path = "/data_log"
-                        if version[8:10] != "W4":
-                            logging.info("Using earlier version of FlashAir")
-                            sdcard.legacy = True
-                        else:
-                            sdcard.legacy = False
-                    except requests.exceptions.ConnectionError:
-                        logging.info("Waiting for connection to flashAir card")
-                        sdcard = None
-            
-            if sdcard is None or data_log_path is None:
-                continue
+                    log_bytes = os.path.getsize(flight_log_path)
+                    if log_bytes == 0:
+                        logging.info("Unexpected empty flight log")
+                        discard_download(flight_log_path)
+                        break
 
-            # List all the files on the SD card
-            try:
-                files = sdcard.files(data_log_path)
-            except requests.exceptions.ConnectionError:
-                logging.info("Lost connection to sd card")
-                continue
-
-            # Filter out to only include G1000 logs
-            if getattr(sdcard, "legacy") != True:
-                files = list(filter(
-                    lambda x: re.match("log_\d+_\d+_(.*).csv", x[1]) != None,
-                    files
-                ))
-            else:
-                files = list(filter(
-                    lambda x: re.match("LOG_(.*).CSV", x[1]) != None,
-                    files
-                ))
-            logging.info("Card has %s files on it, %s files pending", len(files), len(pending_files))
-    
-            # For each file currently on the SD card
-            for download_fname, fname, created_at, filesize in sorted(files, key=lambda x: x[1]):
-                # Check if it's in our local database and skip processing it
-                # unless Force is true
-                Q = Query()
-                result = db.search((Q.type == "log") & (Q.fname == fname))
-
-                needs_update = False
-                
-                if filesize is None:
-                    filesize = 0
-
-                if len(result) > 0:
-                    # TODO do we want to re-process old files?  Given the polling loop, the processed file will likey be smaller
-                    # than the file currently on the SD card
-                    
-                    #try:
-                    #    needs_update = (result[0].get('size') < int(filesize))
-                    #except:
-                    #    logging.exception("unexpected error comparing file sizes")
-                    #    needs_update = False
-                    logging.debug("Already have seen %s (%s): processed size %s current size %s", fname, needs_update, result[0].get('size'), filesize)
-                else:
-                    needs_update = True
-
-                if needs_update == False and (kwargs.get("force") != True):
-                    # The file is in the database and force isn't used, so skip the file
-                    logging.debug("Already have processed %s", fname)
-                else:
-                    # The pending files list is a set of files that we have seen, but haven't yet
-                    # processed.  If a file stays the same size for two checks then it gets processed
-                    # otherwise it is downloaded (since the G1000 will get powered off at the end of the flight)
-                    # and stored in pending files...in practice there should be at most one pending file that
-                    # has been fully download
-                    flight_log = None
                     try:
-                        filesize = int(filesize)
-                    except ValueError:
-                        logging.exception("failed to parse filesize")
-                        continue
-                    if (pending_files.get(fname)) is None or filesize < 128:
-                        # If the file stays the same size it will get processed next check
-                        logging.debug("File %s is currently %s bytes", fname, filesize)
-                        pending_files[fname] = (filesize, None)
-                        continue
-                    else:
-                        # If the file is changing then it's the currently active log file,
-                        # download it so that when the batteries are turned off (thus cutting power
-                        # to opensync) it can be processed
-                        logging.info("Downloading %s %s", fname, download_fname)
-                        try:
-                            flight_log = sdcard.download(download_fname)
-                        except requests.exceptions.ConnectionError:
-                            logging.info("Lost connection to sd card")
-                            break
-                        except:
-                            logging.info("Unexpected error downloading file")
-                            break
-
-                        if not flight_log:
-                            logging.info("Unexpected empty flight log")
-                            break
-
-                        try:
+                        with open(flight_log_path, errors="replace") as flight_log:
                             flight_summary = peek_flight_log(kwargs, db, fname, flight_log)
-                        except:
-                            logging.exception("Unexpected error peeking at flight_log")
-                            flight_summary = {}
+                    except:
+                        logging.exception("Unexpected error peeking at flight_log")
+                        flight_summary = {}
 
-                        old_flight_log = pending_files[fname][1]
-                        if old_flight_log is None:
-                            old_flight_log_size = 0
-                        else:
-                            old_flight_log_size = len(old_flight_log)
-                        if (pending_files[fname][0] != filesize) or old_flight_log_size != len(flight_log):
-                            pending_files[fname] = (filesize, flight_log)
-                            logging.info("File pending %s current size %s bytes %s: %s", fname, filesize, len(flight_log), flight_summary)   
+                    old_flight_log_path = pending_files[fname][1]
+                    if old_flight_log_path is None:
+                        old_log_bytes = 0
+                    else:
+                        old_log_bytes = os.path.getsize(old_flight_log_path)
+                    if (pending_files[fname][0] != filesize) or old_log_bytes != log_bytes:
+                        discard_download(old_flight_log_path)
+                        pending_files[fname] = (filesize, flight_log_path)
+                        logging.info("File pending %s current size %s bytes %s: %s", fname, filesize, log_bytes, flight_summary)   
+                        continue
+                    else:
+                        # The new download is identical to the pending one
+                        discard_download(flight_log_path)
+                        if flight_summary.get('engine_still_running') and flight_summary.get('final_ias') > 50:
+                            logging.info("File %s is still pending at %s bytes because we are still flying", fname, filesize)
                             continue
                         else:
-                            if flight_summary.get('engine_still_running') and flight_summary.get('final_ias') > 50:
-                                logging.info("File %s is still pending at %s bytes because we are still flying", fname, filesize)
-                                continue
-                            else:
-                                _, flight_log = pending_files.pop(fname)
-                                logging.debug("File %s is no longer pending at %s bytes %s: %s", fname, filesize, len(flight_log), flight_summary)
-
-                    # If the file hasn't been downloaded yet
-                    if flight_log is None:
-                        try:
-                            flight_log = sdcard.download(download_fname)
-                        except requests.exceptions.ConnectionError:
-                            logging.info("Lost connection to sd card")
-                            break
-                        except:
-                            logging.info("Unexpected error downloading file")
-                            break
-                    
-                    # Process the flight log
-                    logging.info("Processing %s at %s", fname, download_fname)
-                    record = None
+                            _, flight_log_path = pending_files.pop(fname)
+                            logging.debug("File %s is no longer pending at %s bytes %s: %s", fname, filesize, log_bytes, flight_summary)
+
+                # If the file hasn't been downloaded yet
+                if flight_log_path is None:
                     try:
-                        record = process_flight_log(kwargs, db, fname, flight_log)
+                        flight_log_path = download_flight_log(sdcard, download_fname, kwargs["data_path"])
+                    except requests.exceptions.ConnectionError:
+                        logging.info("Lost connection to sd card")
+                        break
                     except:
-                        logging.exception("Unexpected error processing flight log")
-
-                    # If a record was created and we are connected to a notecard,
-                    # send the message
-                    report_flight(nCard, db, record, flight_log, **kwargs)
-            logging.info("finished polling check")
-        # Sleep 1 second
-        time.sleep(1)
-
+                        logging.info("Unexpected error downloading file")
+                        break
+                
+                # Process the flight log in the background, reporting it can take
+                # much longer than downloading the next file from the SD card
+                logging.info("Processing %s at %s", fname, download_fname)
+                processing.append(
+                    executor.submit(process_downloaded_flight_log, nCard, db, fname, flight_log_path, **kwargs)
+                )
+
+        for p in processing:
+            p.result()
+        logging.info("finished polling check")
+
+    poll_loop(poll_sdcard, battery_status, 10, **kwargs)
+
+    executor.shutdown()
+    if sdcard is not None:
+        sdcard.close()
     logging.info("Beginning shutdown process, processing %s pending files", len(pending_files))
 
     # Log power-down
@@ -546,19 +700,12 @@ def opensync_g1000_wifi_sdcard_process(db, nCard, **kwargs):
         req["text"] = "Open Sync Power Down has %s pending files" % len(pending_files)
         rsp = nCard.Transaction(req)
 
-    for fname, (_, flight_log) in pending_files.items():
+    for fname, (_, flight_log_path) in pending_files.items():
         logging.info("Processing %s", fname)
-        record = None
-        try:
-            record = process_flight_log(kwargs, db, fname, flight_log)
-        except (SystemExit, KeyboardInterrupt):
-            break
-        except:
-            logging.exception("Unexpected error processing flight log")
+        if flight_log_path is None:
+            continue
 
-        # If a record was created and we are connected to a notecard,
-        # send the message
-        report_flight(nCard, db, record, flight_log, **kwargs)
+        process_downloaded_flight_log(nCard, db, fname, flight_log_path, **kwargs)
 
 def opensync_standalone_process(db, nCard, **kwargs):
     # Check if a battery is available, if not then once the batteries are turned off
@@ -568,46 +715,21 @@ def opensync_standalone_process(db, nCard, **kwargs):
     if battery_status == False:
         logging.warning("No battery is available, flights will not be reported on shutdown")
 
-    # Variables used within the main loop
-    version = None
-    external_power_lost_at = None
-    shutdown = False
-    next_check = datetime.datetime.now()
-
-    # The main loop
-    while (not shutdown):
-        
-        if datetime.datetime.now() > next_check:
-            # Schedule the next check
-            next_check = datetime.datetime.now() + datetime.timedelta(seconds=kwargs["poll_period"])
-
-            # Check that the external power is available, if it's been turned off
-            # for more than 1 minute then initiate the shutdown procedure
-            power_status = external_power_available()
-            if power_status and external_power_lost_at is not None:
-                external_power_lost_at = None
-                logging.info("External power restored")
-            elif not power_status and external_power_lost_at is None:
-                external_power_lost_at = datetime.datetime.now()
-                logging.info("External power lost")
-            elif external_power_lost_at is not None and datetime.datetime.now() - external_power_lost_at > datetime.timedelta(minutes=1): # TODO make configurable via kwargs
-                logging.info("External power lost for too long, initiating shutdown")
-                shutdown = True
-
-            if nCard:
-                logging.info("Checking location")
-                req = {"req": "card.location"}
-                rsp = nCard.Transaction(req)
-                logging.info("Location %s", rsp)
+    # Polled every poll period until the external power is lost
+    def poll_location():
+        if nCard:
+            logging.info("Checking location")
+            req = {"req": "card.location"}
+            rsp = nCard.Transaction(req)
+            logging.info("Location %s", rsp)
 
-        # Sleep 1 second
-        time.sleep(1)
+    poll_loop(poll_location, battery_status, 60, **kwargs)
 
     logging.info("Beginning shutdown process")
             
 def opensync(**kwargs):
     # Create the data path which will store the flight metadata and a
-    # pickle copy of the pandas flight logs
+    # parquet copy of the pandas flight logs
     if not os.path.exists(kwargs["data_path"]):
         logging.info("Creating data directory %s", kwargs["data_path"])
         os.makedirs(kwargs["data_path"])
@@ -616,6 +738,12 @@ def opensync(**kwargs):
     dbpath = os.path.join(kwargs["data_path"], "opensync.json")
     db = TinyDB(dbpath)
 
+    # Index the processed flight logs by file name to their processed size, so
+    # that polling doesn't scan the whole database for every file on the card
+    kwargs["log_index"] = {
+        r['fname']: r.get('size', 0) for r in db.search(LOG_Q.type == "log")
+    }
+
     # Connect to NoteHub if requested
     nCard = None
     if kwargs.get("notecard_port") and not kwargs.get("disable_notecard"):
@@ -861,6 +989,13 @@ def main():
         default=120,
         help="connection timeout for making savvy avaition publish"
     )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        type=str.upper,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="logging level"
+    )
     parser.add_argument(
         "files",
         nargs='*',
@@ -868,7 +1003,7 @@ def main():
     )
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=args.log_level)
 
     if GPIO is not None:
         # Nothing special in RaspberryPi mode
@@ -886,6 +1021,7 @@ def main():
             logging.info("Received simulated external power signal")
             EXTERNAL_POWER = not EXTERNAL_POWER
         signal.signal(signal.SIGUSR1, simulate_external_power_loss)
+        wakeup_on_signal()
 
     # Set the data_path to an absolute path 
     args.data_path = os.path.abspath(
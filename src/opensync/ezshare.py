@@ -22,35 +22,67 @@ except ImportError:
     import urequests as requests
 
 import re
+import html
 import logging
 import datetime
 
 try:
-    from bs4 import BeautifulSoup
+    from lxml import etree
 except ImportError:
     # likely in a micropython environment
-    BeautifulSoup = None
+    etree = None
+
+from .listing import Listing, ListingCache
+
+# Directory listing entries, the date and size precede each download link
+FILE_ENTRY_RE = re.compile(
+    r"(\d{4})-( \d{1}|\d{2})-( \d{1}|\d{2})\s+( \d{1}|\d{2}):( \d{1}|\d{2}):( \d{1}|\d{2})\s+(\d+)KB\s*"
+    r"<a\s+href=\"http://[^\"]+/download\?file=([^\"]+)\"[^>]*>([^<]*)</a>",
+    re.IGNORECASE
+)
+DIR_HREF_RE = re.compile(r"dir\?dir=.+")
+VERSION_RE = re.compile(r"<version>([^<]+)</version>", re.IGNORECASE)
 
 
 class EzShare(object):
     def __init__(self, baseurl="http://ezshare.card"):
         self.baseurl = baseurl
+        # Keep the connection to the card open between requests. urequests
+        # has no sessions, so the module itself is used in its place (download
+        # reads its raw socket, as its responses lack iter_content)
+        self.session = requests.Session() if hasattr(requests, "Session") else requests
+        self.listing_cache = ListingCache()
+
+    def close(self):
+        if self.session is not requests:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
     
     def version(self):
-        r = requests.get(f"{self.baseurl}/client?command=version")
+        r = self.session.get(f"{self.baseurl}/client?command=version")
         if r.status_code != 200:
             raise RuntimeError("Failed to fetch version")
 
-        soup = BeautifulSoup(r.text, 'html.parser') # use HTML parser because it's more lienent 
-        try:
-            return soup.response.device.version.string
-        except AttributeError:
-            logging.error("Unexpected error processing response %s %s", r.text, soup)
+        # The response is a small XML document, only the version is needed
+        version_match = VERSION_RE.search(r.text)
+        if version_match is None:
+            logging.error("Unexpected error processing response %s", r.text)
             return None
+        return version_match.group(1)
 
     def files(self, directory="A:"):
         _directory = directory.replace("/", "%5C") # '/' needs to be replaced with %5C for ezShare to work correctly
-        r = requests.get(f"{self.baseurl}/dir?dir={_directory}")
+        url = f"{self.baseurl}/dir?dir={_directory}"
+        r = self.session.get(url, headers=self.listing_cache.headers(url))
+        if r.status_code == 304 and self.listing_cache.lookup(url) is not None:
+            # The directory hasn't changed since it was last listed
+            return self.listing_cache.lookup(url)
+
         if r.status_code != 200:
             raise RuntimeError("Failed to fetch directory list")
 
@@ -60,33 +92,26 @@ class EzShare(object):
         if r.encoding != "ISO-8859-1":
             raise RuntimeError("Received unexpected encoding %s", r.encoding)
 
-        soup = BeautifulSoup(r.text, 'html.parser')
-        
-        #if soup.title.string != f"Index of {directory}":
-        #    logging.warning("Unexpected title in directory list: %s", soup.title.string)
-
-        result = []
-        for a in soup.find_all('a'):
-            if a.previousSibling == None:
-                continue
-            metadata_match = re.match("(\d{4})-( \d{1}|\d{2})-( \d{1}|\d{2})\s+( \d{1}|\d{2}):( \d{1}|\d{2}):( \d{1}|\d{2})\s+(\d+)KB", a.previousSibling.string.strip())
-            fmatch = re.match("http://.+/download\?file=(.+)", a.get('href'))
-            if metadata_match and fmatch:
-                created_at = datetime.datetime(
-                    int(metadata_match.group(1)),
-                    int(metadata_match.group(2)),
-                    int(metadata_match.group(3)),
-                    int(metadata_match.group(4)),
-                    int(metadata_match.group(5)),
-                    int(metadata_match.group(6)),
-                )
-                size_kb = int(metadata_match.group(7))
-                result.append((fmatch.group(1), a.string.strip(), created_at, size_kb))
-
+        # The listing is a plain "Index of" page, so the entries are scanned
+        # for directly rather than building a document tree
+        result = Listing()
+        for entry_match in FILE_ENTRY_RE.finditer(r.text):
+            created_at = datetime.datetime(
+                int(entry_match.group(1)),
+                int(entry_match.group(2)),
+                int(entry_match.group(3)),
+                int(entry_match.group(4)),
+                int(entry_match.group(5)),
+                int(entry_match.group(6)),
+            )
+            size_kb = int(entry_match.group(7))
+            result.append(html.unescape(entry_match.group(8)), html.unescape(entry_match.group(9)).strip(), created_at, size_kb)
+
+        self.listing_cache.update(url, r, result)
         return result
 
     def dirs(self, directory="A:"):
-        r = requests.get(f"{self.baseurl}/dir?dir={directory}")
+        r = self.session.get(f"{self.baseurl}/dir?dir={directory}")
         if r.status_code != 200:
             raise RuntimeError("Failed to fetch directory list")
 
@@ -96,25 +121,49 @@ class EzShare(object):
         if r.encoding != "ISO-8859-1":
             raise RuntimeError("Received unexpected encoding")
 
-        soup = BeautifulSoup(r.text, 'html.parser')
-        
-        if soup.title.string != f"Index of {directory}":
-            logging.warning("Unexpected title in directory list: %s", soup.title.string)
+        # The listing page is small and is fed to the parser whole, only the
+        # title and link elements are reported and their contents are cleared
+        # once they have been handled
+        parser = etree.HTMLPullParser(events=("end",), tag=("title", "a"))
+        parser.feed(r.text)
 
+        title = None
         result = []
-        for a in soup.find_all('a'):
-            if re.match("dir\?dir=.+", a.get('href')):
-                result.append((self.baseurl + "/" + a.get('href'), a.string.strip()))
+        for _, elem in parser.read_events():
+            if elem.tag == "title":
+                title = elem.text
+            elif elem.tag == "a" and DIR_HREF_RE.match(elem.get("href", "")):
+                result.append((self.baseurl + "/" + elem.get("href"), (elem.text or "").strip()))
+            elem.clear()
+        parser.close()
+
+        if title != f"Index of {directory}":
+            logging.warning("Unexpected title in directory list: %s", title)
 
         return result
 
-    def download(self, short_fname):
-        r = requests.get(f"{self.baseurl}/download?file={short_fname}")
-        if r.status_code != 200:
-            raise RuntimeError("Failed to download file")
-        
-        logging.info("Downloading %s: %s", short_fname, r.headers)
-        return r.text
+    def download(self, short_fname, dest, chunk_size=64*1024):
+        # dest is either a path or a file opened in binary mode
+        if isinstance(dest, str):
+            with open(dest, "wb") as f:
+                return self.download(short_fname, f, chunk_size)
+
+        r = self.session.get(f"{self.baseurl}/download?file={short_fname}", stream=True)
+        try:
+            if r.status_code != 200:
+                raise RuntimeError("Failed to download file")
+
+            logging.info("Downloading %s: %s", short_fname, r.headers)
+            if self.session is requests:
+                # urequests has no iter_content, the body is read from the
+                # socket in blocks instead
+                chunks = iter(lambda: r.raw.read(chunk_size), b"")
+            else:
+                chunks = r.iter_content(chunk_size)
+            for chunk in chunks:
+                dest.write(chunk)
+        finally:
+            r.close()
 
 
         
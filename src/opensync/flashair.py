@@ -24,8 +24,8 @@ except ImportError:
 import re
 import logging
 import datetime
-import csv
-import io
+
+from .listing import Listing, ListingCache
 
 """
 
@@ -63,59 +63,66 @@ WLANSD_FILELIST
 
 """
 
+# FAT directory entry attribute bits
+ATTR_READ_ONLY = 0x01
+ATTR_HIDDEN = 0x02 # hidden files don't seem to be returned by 'dir' without perhaps additional info
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+
+def is_file(attributes):
+    return (attributes & (ATTR_ARCHIVE | ATTR_SYSTEM | ATTR_HIDDEN)) == ATTR_ARCHIVE
+
+def is_dir(attributes):
+    return bool(attributes & ATTR_DIRECTORY)
+
 class FlashAir(object):
     def __init__(self, baseurl="http://flashair.local"):
         self.baseurl = baseurl
+        # Keep the connection to the card open between requests. urequests
+        # has no sessions, so the module itself is used in its place (download
+        # reads its raw socket, as its responses lack iter_content)
+        self.session = requests.Session() if hasattr(requests, "Session") else requests
+        self.listing_cache = ListingCache()
+
+    def close(self):
+        if self.session is not requests:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
     
     def version(self):
         """
         F24A6W3AW1.00.03
         F15DBW3BW4.00.03
         """
-        r = requests.get(f"{self.baseurl}/command.cgi?op=108")
+        r = self.session.get(f"{self.baseurl}/command.cgi?op=108")
         if r.status_code != 200:
             raise RuntimeError("Failed to fetch version")
 
         return r.text
 
-    def decodeAttributes(self, attributes):
-        attributes = int(attributes)
-        return {
-            "isArchive": bool((attributes >> 5) & 0x1),
-            "isDirectory": bool((attributes >> 4) & 0x1),
-            "isVolume": bool((attributes >> 3) & 0x1),
-            "isSystem": bool((attributes >> 2) & 0x1),
-            "isHidden": bool((attributes >> 1) & 0x1), # hidden files don't seem to be returned by 'dir' without perhaps additional info
-            "isReadOnly": bool((attributes >> 0) & 0x1),
-        }
-
     def isDir(self, attributes):
-        attrs = self.decodeAttributes(
-            attributes
-        )
-        return attrs["isDirectory"]
+        return is_dir(int(attributes))
 
     def isFile(self, attributes):
-        attrs = self.decodeAttributes(
-            attributes
-        )
-        return (attrs["isArchive"] and not attrs["isSystem"] and not attrs["isHidden"])
+        return is_file(int(attributes))
     
     def decode_time(self, date_val: int, time_val: int):
+        # Fields are clamped to their valid ranges up front, corrupt
+        # timestamps are common on older cards
         year = (date_val >> 9) + 1980  # 0-val is the year 1980
-        month = (date_val & (0b1111 << 5)) >> 5
-        day = date_val & 0b11111
-        hour = time_val >> 11
-        minute = ((time_val >> 5) & 0b111111)
-        second = (time_val & 0b11111) * 2
-        try:
-            decoded = datetime.datetime(year, month, day, hour, minute, second)
-        except ValueError:
-            year = max(1980, year)  # FAT32 doesn't go higher
-            month = min(max(1, month), 12)
-            day = max(1, day)
-            decoded = datetime.datetime(year, month, day, hour, minute, second)
-        return decoded
+        month = min(max(1, (date_val >> 5) & 0b1111), 12)
+        day = max(1, date_val & 0b11111)
+        hour = min(time_val >> 11, 23)
+        minute = min((time_val >> 5) & 0b111111, 59)
+        second = min((time_val & 0b11111) * 2, 59)
+        return datetime.datetime(year, month, day, hour, minute, second)
 
     def files(self, directory="/"):
         """
@@ -127,30 +134,38 @@ class FlashAir(object):
         time is same 15-11 hour, 10-5 minute, 4-0 second/2
         """
         _directory = directory.replace("/", "%2F")
-        r = requests.get(f"{self.baseurl}/command.cgi?op=100&DIR={_directory}")
+        url = f"{self.baseurl}/command.cgi?op=100&DIR={_directory}"
+        r = self.session.get(url, headers=self.listing_cache.headers(url))
+        if r.status_code == 304 and self.listing_cache.lookup(url) is not None:
+            # The directory hasn't changed since it was last listed
+            return self.listing_cache.lookup(url)
+
         if r.status_code != 200:
             raise RuntimeError("Failed to fetch directory list")
 
         if r.headers['Content-Type'] != "text/plain":
             raise RuntimeError("Received unexpected content-type %s", r.headers['Content-Type'])
 
-        result = []
-        reader = csv.reader(io.StringIO(r.text))
-        for line in reader:
+        result = Listing()
+        # The listing fields are never quoted, so the lines are split directly.
+        # The date and time are only converted for files
+        for line in r.text.splitlines():
+            line = line.split(",")
             if len(line) < 6:
                 continue
             dname, fname, size_bytes, attributes, date, time, *_ = line
-            created_at = self.decode_time(int(date), int(time))
-            if self.isFile(attributes):
-                url = f"{self.baseurl}{dname}/{fname}"
-                result.append((f"{dname}/{fname}", fname, created_at, size_bytes))
-            else:
+            if not is_file(int(attributes)):
                 logging.debug("skipping %s because it's not a file %s", fname, line)
+                continue
+            created_at = self.decode_time(int(date), int(time))
+            result.append(f"{dname}/{fname}", fname, created_at, size_bytes)
+
+        self.listing_cache.update(url, r, result)
         return result
 
     def dirs(self, directory="/"):
         _directory = directory.replace("/", "%2F")
-        r = requests.get(f"{self.baseurl}/command.cgi?op=100&DIR={directory}")
+        r = self.session.get(f"{self.baseurl}/command.cgi?op=100&DIR={_directory}")
         if r.status_code != 200:
             raise RuntimeError("Failed to fetch directory list %s" % r.text)
 
@@ -158,20 +173,53 @@ class FlashAir(object):
             raise RuntimeError("Received unexpected content-type %s", r.headers['Content-Type'])
 
         result = []
-        reader = csv.reader(io.StringIO(r.text))
-        for line in reader:
+        for line in r.text.splitlines():
+            line = line.split(",")
             if len(line) < 6:
                 continue
             dir, fname, size, attributes, date, time, *_ = line
-            if self.isDir(attributes):
+            if is_dir(int(attributes)):
                 result.append(fname)
 
         return result
 
-    def download(self, fname):
-        r = requests.get(f"{self.baseurl}/{fname}", headers={"Accept": "*/*"})
-        if r.status_code != 200:
-            raise RuntimeError("Failed to download file")
-        
-        logging.info("Downloading %s: %s", fname, r.headers)
-        return r.text
\ No newline at end of file
+    def walk(self, root="/", max_workers=4):
+        """
+        Lists root and every directory below it, the directories on each
+        level of the tree are listed concurrently
+        """
+        import concurrent.futures
+
+        result = [root]
+        level = [root]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while level:
+                next_level = []
+                for directory, names in zip(level, executor.map(self.dirs, level)):
+                    next_level.extend(f"{directory.rstrip('/')}/{name}" for name in names)
+                result.extend(next_level)
+                level = next_level
+        return result
+
+    def download(self, fname, dest, chunk_size=64*1024):
+        # dest is either a path or a file opened in binary mode
+        if isinstance(dest, str):
+            with open(dest, "wb") as f:
+                return self.download(fname, f, chunk_size)
+
+        r = self.session.get(f"{self.baseurl}/{fname}", headers={"Accept": "*/*"}, stream=True)
+        try:
+            if r.status_code != 200:
+                raise RuntimeError("Failed to download file")
+
+            logging.info("Downloading %s: %s", fname, r.headers)
+            if self.session is requests:
+                # urequests has no iter_content, the body is read from the
+                # socket in blocks instead
+                chunks = iter(lambda: r.raw.read(chunk_size), b"")
+            else:
+                chunks = r.iter_content(chunk_size)
+            for chunk in chunks:
+                dest.write(chunk)
+        finally:
+            r.close()
\ No newline at end of file
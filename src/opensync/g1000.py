@@ -21,8 +21,12 @@ import numpy as np
 import datetime
 import logging
 import math
+import numbers
 from io import StringIO
 import os
+import functools
+
+geo_a = None
 try:
     from neobase import NeoBase, OPTD_POR_URL
     mydir=os.path.dirname(__file__)
@@ -41,46 +45,56 @@ try:
     
 except ImportError:
     logging.debug("cannot lookup airports without neobase")
-    geo_a = None
 
 if geo_a is None:
     logging.warning("cannot lookup airports without neobase and airport database")
 
 def coerce_float(v):
+    # Empty cells are common, check for them before raising an exception
+    v = v.strip()
+    if not v or v[0] not in "+-.0123456789":
+        return None
     try:
         return float(v)
     except ValueError:
         return None
 
 def coerce_date(v):
+    if not v:
+        return None
     try:
         return datetime.datetime.strptime(v, "%Y-%m-%d")
     except ValueError:
         return None
 
 def coerce_time(v):
+    if not v:
+        return None
     try:
         return datetime.datetime.strptime(v, "%H:%M:%S")
     except ValueError:
         return None
 
+# Only a handful of UTC offsets are ever seen, the timezones are shared
+@functools.lru_cache(maxsize=64)
 def coerce_tzinfo(v):
     try:
         if v == "+00:00":
             return datetime.timezone.utc
         else:
-            hours, minutes = v.split(":")
+            # the sign applies to the minutes as well, -03:30 is -3h30m
+            sign = -1 if v.startswith("-") else 1
+            hours, minutes = v.lstrip("+-").split(":")
             hours = int(hours)
             minutes = int(minutes)
-            return datetime.timezone(datetime.timedelta(hours=hours, minutes=minutes))
+            return datetime.timezone(sign * datetime.timedelta(hours=hours, minutes=minutes))
     except ValueError:
         return None
 
 def table_format(v):
-    try:
-        return "%0.2f" % v
-    except TypeError:
-        return str(v)
+    if isinstance(v, numbers.Real) and not isinstance(v, bool):
+        return f"{v:0.2f}"
+    return str(v)
 
 G1000_TYPES = {
     'yyy-mm-dd': coerce_date,
@@ -112,64 +126,108 @@ G1000_TYPES = {
     'mt': str,
 }
 
-def iter_parse_flight_log(flight_log_lines, flight_log_types, flight_log_fields):
+def read_flight_log_rows(flight_log_lines, flight_log_types, flight_log_fields):
+    # If there are no time fields we should just skip
+    if not all(field in flight_log_fields for field in ('Lcl Date', 'Lcl Time', 'UTCOfst')):
+        return pd.DataFrame(columns=flight_log_fields)
+
+    # Only complete rows are parsed, the end of a flight log is sometimes only
+    # a partial line because the MFD got turned off in the middle
+    num_fields = len(flight_log_fields)
+    rows = "".join( ll + "\n" for ll in flight_log_lines if ll.count(",") == num_fields - 1 )
+    if not rows:
+        return pd.DataFrame(columns=flight_log_fields)
+    rows = StringIO(rows)
+
+    # Numeric fields are parsed by the C parser directly, everything else is
+    # read as text and then converted a column at a time according to the
+    # G1000 field type
+    field_coerces = [ G1000_TYPES.get(field_type, str) for field_type in flight_log_types ]
+    float_idx = [ ii for ii, field_coerce in enumerate(field_coerces) if field_coerce is coerce_float ]
+    # Sensor readings only have a few significant digits so float32 holds
+    # them exactly, latitude and longitude need double precision
+    float_dtypes = {
+        ii: (np.float64 if flight_log_types[ii] == 'degrees' else np.float32) for ii in float_idx
+    }
     try:
-        time_fields = (
-            flight_log_fields.index('Lcl Date'),
-            flight_log_fields.index('Lcl Time'),
-            flight_log_fields.index('UTCOfst')
+        data = pd.read_csv(
+            rows,
+            header=None,
+            names=range(num_fields),
+            dtype={ ii: float_dtypes.get(ii, str) for ii in range(num_fields) },
+            keep_default_na=False,
+            na_values={ ii: [''] for ii in float_idx },
+            engine='c'
         )
     except ValueError:
-        time_fields = None
-
-    # If there are no time fields we should just skip
-    if time_fields is None:
-        return
+        # A numeric field holds something else, read it as text instead
+        rows.seek(0)
+        data = pd.read_csv(
+            rows,
+            header=None,
+            names=range(num_fields),
+            dtype=str,
+            keep_default_na=False,
+            engine='c'
+        )
+    data.columns = flight_log_fields
 
-    # Next lines are CSV values
-    for ll in  flight_log_lines:
-        data_record = []
-        for ii, vv in enumerate( ll.split(",") ):
-            field_type = flight_log_types[ii]
-            field_name = flight_log_fields[ii]
-            field_coerce = G1000_TYPES.get(field_type, str)
-            try:
-                data_record.append( field_coerce(vv.strip()) )
-            except ValueError:
-                logging.exception("Failed to coerce field %s with value %s", field_name, vv.strip())
+    for ii, (field_coerce, field_name) in enumerate(zip(field_coerces, flight_log_fields)):
+        values = data.iloc[:, ii]
+        if field_coerce is coerce_float:
+            if values.dtype == float_dtypes[ii]:
                 continue
-
-        # only report full data records with time
-        if len(data_record) != len(flight_log_fields):
+            values = pd.to_numeric(values, errors='coerce').astype(float_dtypes[ii])
+        elif field_coerce in (str, bool):
+            values = values.str.strip().astype(field_coerce)
+        elif field_name == 'Lcl Time':
+            # Joined with the date below
             continue
+        else:
+            # Dates and UTC offsets only have a handful of distinct values
+            values = values.str.strip()
+            values = values.map({ v: field_coerce(v) for v in values.unique() })
+        data.isetitem(ii, values)
+
+    # Join the date and utc offset into the time record
+    # so that you can use that column by itself, otherwise
+    # Lcl Time will use the date from the system clock
+    _date = data['Lcl Date']
+    _tz = data['UTCOfst']
+    _time = pd.to_datetime(
+        _date.dt.strftime("%Y-%m-%d") + " " + data['Lcl Time'].str.strip(),
+        format="%Y-%m-%d %H:%M:%S",
+        errors='coerce'
+    )
 
-        _date = data_record[time_fields[0]]
-        _time = data_record[time_fields[1]]
-        _tz = data_record[time_fields[2]]
-
-        # skip rows that can't create a valid time
-        if (_date is None) or (_time is None) or (_tz is None):
-            continue
+    # skip rows that can't create a valid time
+    valid = _date.notna() & _time.notna() & _tz.notna()
+    data = data[valid].reset_index(drop=True)
+    _time = _time[valid].reset_index(drop=True)
+    _tz = data['UTCOfst']
 
-        # Join the date and utc offset into the time record
-        # so that you can use that column by itself, otherwise
-        # Lcl Time will use the date from the system clock
-        data_record[time_fields[1]] = datetime.datetime.combine(
-            data_record[time_fields[0]].date(),
-            data_record[time_fields[1]].time(),
-            data_record[time_fields[2]],
-        )
+    offsets = _tz.unique()
+    if len(offsets) == 1:
+        data['Lcl Time'] = _time.dt.tz_localize(offsets[0])
+    else:
+        data['Lcl Time'] = [ t.to_pydatetime().replace(tzinfo=tz) for t, tz in zip(_time, _tz) ]
 
-        yield data_record
+    return data
 
 def parse_flight_log(flight_log):
+    # The flight log is either the contents of the log or an open file,
+    # files are read line by line rather than loaded in full
+    if isinstance(flight_log, str):
+        flight_log = StringIO(flight_log)
+    lines = ( x.strip() for x in flight_log )
+
     # The first line is the airframe info
-    lines = [ x.strip() for x in flight_log.split("\n") ]
-    if not lines[0].startswith('#airframe_info, log_version="1.00"'):
+    airframe_line = next(lines, "")
+    if not airframe_line.startswith('#airframe_info, log_version="1.00"'):
         raise RuntimeError("unsupported flight log format")
 
     airframe_info = {}
-    for airframe_field in lines[0].split(","):
+    for airframe_field in airframe_line.split(","):
         try:
             field_name, field_value = airframe_field.split("=")
         except ValueError:
@@ -179,33 +237,66 @@ def parse_flight_log(flight_log):
         airframe_info[field_name] = field_value
 
     # Next two lines are field types and field names
-    flight_log = []
-    types = [ x.strip("#").strip() for x in lines[1].split(",") ]
-    fields = [ x.strip() for x in lines[2].split(",") ]
+    types = [ x.strip("#").strip() for x in next(lines).split(",") ]
+    fields = [ x.strip() for x in next(lines).split(",") ]
 
-    data = pd.DataFrame.from_records(
-        iter_parse_flight_log(lines[3:], types, fields),
-        columns = fields
-    )
+    data = read_flight_log_rows(lines, types, fields)
     logging.info("loaded airframe info %s", airframe_info)
     logging.info("loaded flight log with %s data points", len(data))
     
     return airframe_info, data
 
+def float32_to_float(values):
+    """
+    Converts float32 readings to Python floats through their shortest decimal
+    representation, so that 360.99 stays 360.99 rather than 360.989990234375
+    """
+    return np.asarray(values, dtype=np.float32).astype(str).astype(float).tolist()
+
+def rolling_median(values, start, stop, window=15):
+    """
+    Centered rolling median of values[start:stop], only the rows that
+    those windows cover are used
+    """
+    start, stop, _ = slice(start, stop).indices(len(values))
+    first = max(0, start - window // 2)
+    medians = values.iloc[first:stop + window // 2].rolling(window, min_periods=1, center=True).median()
+    return medians.iloc[start - first:stop - first]
+
+def accumulated_time(times, started, stopped):
+    """
+    Total time from each row where started is true until the next row where
+    stopped is true, rows where neither is true leave the state unchanged
+    """
+    running = np.where(started, 1.0, np.where(stopped, 0.0, np.nan))
+    running = pd.Series(running).ffill().fillna(0.0).to_numpy(dtype=np.int8)
+
+    edges = np.diff(running, prepend=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # still running at the end of the log
+    if len(ends) < len(starts):
+        ends = np.append(ends, len(times) - 1)
+
+    total = (times[ends] - times[starts]).sum()
+    return pd.Timedelta(total).to_pytimedelta()
+
+@functools.lru_cache(maxsize=1024)
+def nearest_airport(lat, lon, radius=10):
+    """
+    The closest airport within radius kilometers of the position
+    """
+    for distance, airport in geo_a.find_closest_from_location((lat, lon), N=1):
+        if distance <= radius:
+            return airport
+    return None
+
 def summarize_flight_log(flight_log_df):
     summary = {}
 
-    summary['beg_time'] = datetime.datetime.combine(
-        flight_log_df.iloc[0]['Lcl Date'].date(),
-        flight_log_df.iloc[0]['Lcl Time'].time(),
-        flight_log_df.iloc[0]['UTCOfst']
-    ).isoformat()
-
-    summary['end_time'] = datetime.datetime.combine(
-        flight_log_df.iloc[-1]['Lcl Date'].date(),
-        flight_log_df.iloc[-1]['Lcl Time'].time(),
-        flight_log_df.iloc[-1]['UTCOfst']
-    ).isoformat()
+    # Lcl Time already carries the date and UTC offset
+    summary['beg_time'] = flight_log_df['Lcl Time'].iloc[0].isoformat()
+    summary['end_time'] = flight_log_df['Lcl Time'].iloc[-1].isoformat()
 
     # Only include lines where the GPS has locked, this has the side-effect
     # of also ensure most of the other sensor values are stablized
@@ -215,153 +306,125 @@ def summarize_flight_log(flight_log_df):
     if len(flight_log_df) == 0:
         return summary
 
+    # UTC timestamps of every row, computed once for the fuel integration
+    # and the Hobbs and flight time estimates. The to_datetime cache is for
+    # repeated strings, just deciding whether to use it boxes every row
+    times = pd.to_datetime(flight_log_df['Lcl Time'], utc=True, cache=False).to_numpy(dtype='datetime64[ns]')
+
     # Fuel Summary
-    # Use rolling average to smooth out the noise
-    total_fuel_rolling = (flight_log_df['FQtyL'] + flight_log_df['FQtyR']).rolling(15, min_periods=1, center=True).median()
+    # Use a rolling median to smooth out the noise
+    total_fuel = flight_log_df['FQtyL'] + flight_log_df['FQtyR']
     
     # TODO if fuel read-outs are constantly adjusting due to turns
     # and such, see if we can find some smoothing filter
-    summary['max_fuel'] = total_fuel_rolling[30:60].max()
-    summary['min_fuel'] = total_fuel_rolling[-15:].min()
+    summary['max_fuel'] = float32_to_float(rolling_median(total_fuel, 30, 60).max())
+    summary['min_fuel'] = float32_to_float(rolling_median(total_fuel, -15, None).min())
     summary['fuel_remaining'] = summary['min_fuel']
 
     # Trapizodal integration over the data
     try:
         summary['fuel_consumed'] = 0
-        fuel_flow = flight_log_df[['Lcl Time', 'E1 FFlow']].dropna()
-        summary['fuel_consumed'] = np.trapz(y=fuel_flow['E1 FFlow'], x=fuel_flow['Lcl Time'].view('int64')) / (3600 * 10**9)
+        fuel_flow = flight_log_df['E1 FFlow'].to_numpy()
+        has_fuel_flow = ~np.isnan(fuel_flow)
+        summary['fuel_consumed'] = np.trapz(y=fuel_flow[has_fuel_flow], x=times[has_fuel_flow].view('int64')) / (3600 * 10**9)
     except:
         logging.exception("error calculating fuel consumed")
         summary['fuel_consumed'] = summary['max_fuel'] - summary['min_fuel']
 
+    # Reduce all of the columns needed for the engine, performance and
+    # battery summaries together rather than one column at a time
+    cht_columns = [ f'E1 CHT{ii}' for ii in range(1,7) ]
+    egt_columns = [ f'E1 EGT{ii}' for ii in range(1,7) ]
+    tit_columns = [ f'E1 TIT{ii}' for ii in range(1,3) ]
+    max_columns = cht_columns + egt_columns + tit_columns + [
+        'E1 OilT', 'E1 OilP', 'E1 MAP', 'E1 RPM', 'IAS', 'TAS', 'LatAc', 'NormAc', 'amp1'
+    ]
+    min_columns = [ 'volt1', 'volt2' ]
+    maxes = dict(zip(max_columns, float32_to_float(flight_log_df[max_columns].max())))
+    mins = dict(zip(min_columns, float32_to_float(flight_log_df[min_columns].min())))
+
     # Engine Summary
-    summary['max_cht'] = [ flight_log_df[f'E1 CHT{ii}'].max() for ii in range(1,7) ]
-    summary['max_egt'] = [ flight_log_df[f'E1 EGT{ii}'].max() for ii in range(1,7) ]
-    summary['max_tit'] = [ flight_log_df[f'E1 TIT{ii}'].max() for ii in range(1,3) ]
-    summary['max_oil_temp'] = flight_log_df['E1 OilT'].max()
-    summary['max_oil_pressure'] = flight_log_df['E1 OilP'].max()
-    summary['max_manifold_pressure'] = flight_log_df['E1 MAP'].max()
-    summary['max_rpm'] = flight_log_df['E1 RPM'].max()
+    summary['max_cht'] = [ maxes[column] for column in cht_columns ]
+    summary['max_egt'] = [ maxes[column] for column in egt_columns ]
+    summary['max_tit'] = [ maxes[column] for column in tit_columns ]
+    summary['max_oil_temp'] = maxes['E1 OilT']
+    summary['max_oil_pressure'] = maxes['E1 OilP']
+    summary['max_manifold_pressure'] = maxes['E1 MAP']
+    summary['max_rpm'] = maxes['E1 RPM']
 
     # Performance Summary
-    summary['max_ias'] = flight_log_df[f'IAS'].max()
-    summary['max_tas'] = flight_log_df[f'TAS'].max()
-    summary['max_lat_accel'] = flight_log_df[f'LatAc'].max()
-    summary['max_norm_accel'] = flight_log_df[f'NormAc'].max()
+    summary['max_ias'] = maxes['IAS']
+    summary['max_tas'] = maxes['TAS']
+    summary['max_lat_accel'] = maxes['LatAc']
+    summary['max_norm_accel'] = maxes['NormAc']
 
     # Battery Summary
-    summary['min_bat1_volts'] = flight_log_df['volt1'].min()
-    summary['min_bat2_volts'] = flight_log_df['volt2'].min()
-    summary['max_bat1_amps'] = flight_log_df['amp1'].max()
+    summary['min_bat1_volts'] = mins['volt1']
+    summary['min_bat2_volts'] = mins['volt2']
+    summary['max_bat1_amps'] = maxes['amp1']
     
     # Estimate flight time and Hobbs Time
     # POH states flight time is accumulated whenever KIAS > 35KTS
-    start_hobbs = None
-    end_hobbs = None
-    total_hobbs_time = datetime.timedelta(hours=0, minutes=0)
-    for ii, rpm in enumerate(flight_log_df['E1 RPM']):
-        if rpm > 0.0 and start_hobbs is None:
-            start_hobbs = datetime.datetime.combine(
-                flight_log_df.iloc[ii]['Lcl Date'].date(),
-                flight_log_df.iloc[ii]['Lcl Time'].time(),
-                flight_log_df.iloc[ii]['UTCOfst']
-            )
-            end_hobbs = None
-        elif rpm <= 0.0 and start_hobbs is not None:
-            end_hobbs = datetime.datetime.combine(
-                flight_log_df.iloc[ii]['Lcl Date'].date(),
-                flight_log_df.iloc[ii]['Lcl Time'].time(),
-                flight_log_df.iloc[ii]['UTCOfst']
-            )
-            hobbs_time = end_hobbs - start_hobbs
-            total_hobbs_time += hobbs_time
-            start_hobbs = None
-            end_hobbs = None
-
-    if start_hobbs is not None and end_hobbs is None:
-        end_hobbs = datetime.datetime.combine(
-            flight_log_df.iloc[-1]['Lcl Date'].date(),
-            flight_log_df.iloc[-1]['Lcl Time'].time(),
-            flight_log_df.iloc[-1]['UTCOfst']
-        )
-        hobbs_time = end_hobbs - start_hobbs
-        total_hobbs_time += hobbs_time
+    rpm = flight_log_df['E1 RPM'].to_numpy()
+    total_hobbs_time = accumulated_time(times, rpm > 0.0, rpm <= 0.0)
 
     hobbs_hours = (total_hobbs_time.days * 24) + int(float(total_hobbs_time.seconds) / 3600)
     hobbs_fractional_hours = math.ceil((float(total_hobbs_time.seconds % 3600) / 360)) * 0.1
     summary['hobbs_time'] = hobbs_hours + hobbs_fractional_hours
 
-    start_flight = None
-    end_flight = None
-    total_flight_time = datetime.timedelta(hours=0, minutes=0)
-    for ii, kias in enumerate(flight_log_df['IAS']):
-        if kias > 35 and start_flight is None:
-            start_flight = datetime.datetime.combine(
-                flight_log_df.iloc[ii]['Lcl Date'].date(),
-                flight_log_df.iloc[ii]['Lcl Time'].time(),
-                flight_log_df.iloc[ii]['UTCOfst']
-            )
-            end_flight = None
-        elif kias < 35 and start_flight is not None:
-            end_flight = datetime.datetime.combine(
-                flight_log_df.iloc[ii]['Lcl Date'].date(),
-                flight_log_df.iloc[ii]['Lcl Time'].time(),
-                flight_log_df.iloc[ii]['UTCOfst']
-            )
-            flight_time = end_flight - start_flight
-            total_flight_time += flight_time
-
-            start_flight = None
-            end_flight = None
-
-    if start_flight is not None and end_flight is None:
-        end_flight = datetime.datetime.combine(
-            flight_log_df.iloc[-1]['Lcl Date'].date(),
-            flight_log_df.iloc[-1]['Lcl Time'].time(),
-            flight_log_df.iloc[-1]['UTCOfst']
-        )
-        flight_time = end_flight - start_flight
-        total_flight_time += flight_time
+    kias = flight_log_df['IAS'].to_numpy()
+    total_flight_time = accumulated_time(times, kias > 35, kias < 35)
 
     flight_hours = (total_flight_time.days * 24) + int(float(total_flight_time.seconds) / 3600)
     flight_fractional_hours = math.ceil((float(total_flight_time.seconds % 3600) / 360)) * 0.1
     summary['flight_time'] = flight_hours + flight_fractional_hours
 
     # Locations
-    ii = flight_log_df['Latitude'].first_valid_index()
-    if ii is not None:
-        summary['origin_pos'] = {
-            'lat': flight_log_df.iloc[ii]['Latitude'],
-            'lon': flight_log_df.iloc[ii]['Longitude'],
-        }
-
-    ii = flight_log_df['Latitude'].last_valid_index()
-    if ii is not None:
-        summary['destination_pos'] = {
-            'lat': flight_log_df.iloc[ii]['Latitude'],
-            'lon': flight_log_df.iloc[ii]['Longitude'],
-        }
+    # Rows without a GPS position were dropped above, so the first and last
+    # rows hold the first and last valid positions
+    latitudes = flight_log_df['Latitude'].to_numpy()
+    longitudes = flight_log_df['Longitude'].to_numpy()
+    summary['origin_pos'] = {
+        'lat': float(latitudes[0]),
+        'lon': float(longitudes[0]),
+    }
+    summary['destination_pos'] = {
+        'lat': float(latitudes[-1]),
+        'lon': float(longitudes[-1]),
+    }
 
+    # Positions are rounded to ~100m so that flights parked at the same
+    # spot share cached lookups
     if (summary.get('origin_pos') is not None) and (geo_a is not None):
-        point = summary["origin_pos"]["lat"], summary["origin_pos"]["lon"]
-        origin_airports = [k for (_, k) in sorted(geo_a.find_near_location(point, 10), key=lambda x: x[0]) ]
-        if origin_airports:
-            summary["origin"] = origin_airports[0]
+        origin = nearest_airport(round(summary["origin_pos"]["lat"], 3), round(summary["origin_pos"]["lon"], 3))
+        if origin:
+            summary["origin"] = origin
 
     if (summary.get('destination_pos') is not None) and (geo_a is not None):
-        point = summary["destination_pos"]["lat"], summary["destination_pos"]["lon"]
-        destination_airports = [k for (_, k) in sorted(geo_a.find_near_location(point, 10), key=lambda x: x[0]) ]
-        if destination_airports:
-            summary["destination"] = destination_airports[0]
+        destination = nearest_airport(round(summary["destination_pos"]["lat"], 3), round(summary["destination_pos"]["lon"], 3))
+        if destination:
+            summary["destination"] = destination
     else:
         logging.info("Not looking up destination airport")
 
     summary['engine_still_running'] = bool( flight_log_df.iloc[-1]['E1 RPM'] > 500 )
-    summary['final_ias'] = flight_log_df.iloc[-1]['IAS']
-    summary['final_alt'] = flight_log_df.iloc[-1]['AltMSL']
+    summary['final_ias'] = float32_to_float(flight_log_df['IAS'].iloc[-1])
+    summary['final_alt'] = float32_to_float(flight_log_df['AltMSL'].iloc[-1])
 
     return summary
 
+def summarize_flight_log_file(fpath):
+    # Used as a worker process by __main__, so errors are logged here
+    try:
+        with open(fpath, errors="replace") as flight_log:
+            airframe_info, flight_log_df = parse_flight_log(flight_log)
+        return summarize_flight_log(flight_log_df)
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except:
+        logging.exception("Unexpected error processing flight log %s", fpath)
+        return None
+
 DEFAULT_KEEP_COLUMNS = (
     "Lcl Date",
     "Lcl Time",
@@ -393,11 +456,11 @@ DEFAULT_KEEP_COLUMNS = (
     "volt2",
     "amp1",
 )
-def prune_flight_log(flight_log, output, keep_columns=DEFAULT_KEEP_COLUMNS):
+def iter_prune_flight_log(flight_log, keep_columns=DEFAULT_KEEP_COLUMNS):
     for ii, ll in enumerate(flight_log):
         # The first line is the airframe info
         if ii == 0:
-            output.write(ll)
+            yield ll
         elif ii == 1:
             types = [ x.strip() for x in ll.split(",") ]
         elif ii == 2:
@@ -409,40 +472,59 @@ def prune_flight_log(flight_log, output, keep_columns=DEFAULT_KEEP_COLUMNS):
                     keep_idx.append(idx)             
 
             row = [ types[idx] for idx in keep_idx]
-            output.write(",".join(row))
-            output.write("\n")
+            yield ",".join(row) + "\n"
 
             row = [ fields[idx] for idx in keep_idx]
-            output.write(",".join(row))
-            output.write("\n")
+            yield ",".join(row) + "\n"
         else:
-            row = [ x.strip() for x in ll.split(",") ]
+            row = ll.split(",")
             # the end of a flight log is sometimes only a partial line
             # because the MFD got turned off in the middle
             if len(fields) != len(row):
                 continue
-            row = [ row[idx] for idx in keep_idx]
-            output.write(",".join(row))
-            output.write("\n")
+            # only the kept fields are stripped
+            yield ",".join([ row[idx].strip() for idx in keep_idx ]) + "\n"
+
+def prune_flight_log(flight_log, output, keep_columns=DEFAULT_KEEP_COLUMNS):
+    output.writelines(iter_prune_flight_log(flight_log, keep_columns))
 
 def to_elasticsearch(flight_log_df):
-    for record in flight_log_df.to_dict(orient='records'):
-        record['@timestamp'] = datetime.datetime.combine(
-            record['Lcl Date'].date(),
-            record['Lcl Time'].time(),
-            record['UTCOfst']
-        ).isoformat()
-
-        record['Lcl Date'] = str(record['Lcl Date'])
-        record['Lcl Time'] = str(record['Lcl Time'])
-        record['UTCOfst'] = str(record['UTCOfst'])
-
-        if record['Latitude'] and record['Longitude']:
-            if not (math.isnan(record['Latitude']) or math.isnan(record['Longitude'])):
-                record['geo.point'] = {
-                    "lat": record['Latitude'],
-                    "lon": record['Longitude'],
-                }
+    if len(flight_log_df) == 0:
+        return
+
+    # The records are assembled from whole columns converted up front,
+    # rather than converting the fields of every record
+    timestamps = [ t.isoformat() for t in flight_log_df['Lcl Time'] ]
+    utc_offsets = flight_log_df['UTCOfst']
+    fields = list(flight_log_df.columns)
+    columns = {
+        field: flight_log_df[field].tolist()
+        for field in fields if field not in ('Lcl Date', 'Lcl Time', 'UTCOfst')
+    }
+    # float32 readings are indexed as written in the log, not widened
+    for field, dtype in flight_log_df.dtypes.items():
+        if dtype == np.float32:
+            columns[field] = float32_to_float(flight_log_df[field])
+    columns['Lcl Date'] = flight_log_df['Lcl Date'].dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+    columns['Lcl Time'] = [ t.replace("T", " ", 1) for t in timestamps ]
+    columns['UTCOfst'] = utc_offsets.map({ tz: str(tz) for tz in utc_offsets.unique() }).tolist()
+
+    # Missing values are left out of the records entirely
+    missing = flight_log_df.isna().to_numpy()
+
+    latitudes = flight_log_df['Latitude'].to_numpy()
+    longitudes = flight_log_df['Longitude'].to_numpy()
+    has_position = (latitudes != 0) & (longitudes != 0) & ~np.isnan(latitudes) & ~np.isnan(longitudes)
+
+    rows = zip(*( columns[field] for field in fields ))
+    for row, row_missing, timestamp, lat, lon, valid in zip(rows, missing, timestamps, latitudes.tolist(), longitudes.tolist(), has_position):
+        record = { field: value for field, value, is_missing in zip(fields, row, row_missing) if not is_missing }
+        record['@timestamp'] = timestamp
+        if valid:
+            record['geo.point'] = {
+                "lat": lat,
+                "lon": lon,
+            }
 
         yield record
         
@@ -531,9 +613,7 @@ OPENSYNC_MAPPING = {
 if __name__ == "__main__":
     import argparse
     import os
-    import json
-    import math
-    import time
+    import concurrent.futures
     from prettytable import PrettyTable
 
     parser = argparse.ArgumentParser()
@@ -560,43 +640,45 @@ if __name__ == "__main__":
         args.fields = [ "date", "origin", "destination", "hobbs_time", "flight_time", "max_fuel", "min_fuel", "fuel_consumed", "fuel_remaining" ]
     table.field_names = args.fields
 
-    for ff in sorted(files, key=lambda x: os.path.basename(x)):
-        if os.path.isfile(ff):
-            if args.prune:
-                 with open(args.prune, "w") as prune_out:
-                     with open(ff, errors="replace") as flight_log:
-                        prune_flight_log(flight_log, prune_out)
-            else:
+    files = sorted((ff for ff in files if os.path.isfile(ff)), key=lambda x: os.path.basename(x))
+
+    if args.prune:
+        for ff in files:
+            with open(args.prune, "w") as prune_out:
                 with open(ff, errors="replace") as flight_log:
-                    try:
-                        airframe_info, flight_log = parse_flight_log(flight_log.read())
-                        print()
-                        if args.opensearch:
-                            # Delete previous records to avoid inserting duplicate
-                            OS.delete_by_query(index="opensync", body={"query": {"term": {"filename": os.path.basename(ff) } } })
-
-                            docs = []
-                            for doc in to_elasticsearch(flight_log):
-                                for f in list(doc.keys()):
-                                    if (isinstance(doc[f], float) and math.isnan(doc[f])) or doc[f] is None:
-                                        del doc[f]
-                                # TODO convert to bulkd
-                                doc['filename'] = os.path.basename(ff)
-                                docs.append(doc)
-                            helpers.bulk(OS, docs, index='opensync')
-                            time.sleep(1) # rate limit
-                            #print(doc)
-                            #OS.index(index="opensync", body=json.dumps(doc))
-                        else:
-                            summary = summarize_flight_log(flight_log)
-                            if "date"in args.fields and summary.get("beg_time"):
-                                summary["date"] = summary["beg_time"][0:10]
-                            if summary.get("hobbs_time", 0) > 0.01:
-                                print(summary)
-                                table.add_row([ table_format(summary.get(xx, "")) for xx in args.fields ])
-
-                    except (SystemExit, KeyboardInterrupt):
-                        raise
-                    except:
-                        logging.exception("Unexpected error processing flight log %s", ff)
-                print(table)
\ No newline at end of file
+                    prune_flight_log(flight_log, prune_out)
+
+    elif args.opensearch:
+        for ff in files:
+            with open(ff, errors="replace") as flight_log:
+                try:
+                    airframe_info, flight_log = parse_flight_log(flight_log)
+                    print()
+                    # Delete previous records to avoid inserting duplicate
+                    OS.delete_by_query(index="opensync", body={"query": {"term": {"filename": os.path.basename(ff) } } })
+
+                    # Documents are streamed to the bulk API in chunks, requests
+                    # rejected because the cluster is busy are retried with backoff
+                    fname = os.path.basename(ff)
+                    docs = ( dict(doc, filename=fname) for doc in to_elasticsearch(flight_log) )
+                    helpers.bulk(OS, docs, index='opensync', chunk_size=2000, max_retries=3, request_timeout=60)
+
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except:
+                    logging.exception("Unexpected error processing flight log %s", ff)
+
+    else:
+        # Each file is parsed and summarized in a worker process, the
+        # summaries are returned in file order
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            for summary in executor.map(summarize_flight_log_file, files, chunksize=4):
+                print()
+                if summary is not None:
+                    if "date"in args.fields and summary.get("beg_time"):
+                        summary["date"] = summary["beg_time"][0:10]
+                    if summary.get("hobbs_time", 0) > 0.01:
+                        print(summary)
+                        table.add_row([ table_format(summary.get(xx, "")) for xx in args.fields ])
+
+        print(table)
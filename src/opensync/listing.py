@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# OpenSync
+# Copyright (C) 2022 Michael Ihde
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+class Listing(object):
+    """
+    The files in a SD card directory, stored as one list per column
+
+    Iterating or indexing a listing produces (path, name, created_at, size)
+    tuples, so it can be used wherever a list of tuples was used
+    """
+    def __init__(self, paths=None, names=None, created_at=None, sizes=None):
+        self.paths = paths if paths is not None else []
+        self.names = names if names is not None else []
+        self.created_at = created_at if created_at is not None else []
+        self.sizes = sizes if sizes is not None else []
+
+    def append(self, path, name, created_at, size):
+        self.paths.append(path)
+        self.names.append(name)
+        self.created_at.append(created_at)
+        self.sizes.append(size)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return zip(self.paths, self.names, self.created_at, self.sizes)
+
+    def __getitem__(self, idx):
+        return (self.paths[idx], self.names[idx], self.created_at[idx], self.sizes[idx])
+
+    def as_tuples(self):
+        return list(self)
+
+class ListingCache(object):
+    """
+    Listings by URL along with the ETag and Last-Modified headers they were
+    served with, so that they can be requested again conditionally
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def headers(self, url):
+        headers = {}
+        if url in self.entries:
+            etag, last_modified, _ = self.entries[url]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def lookup(self, url):
+        if url in self.entries:
+            return self.entries[url][2]
+        return None
+
+    def update(self, url, r, listing):
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if etag or last_modified:
+            self.entries[url] = (etag, last_modified, listing)
+        else:
+            self.entries.pop(url, None)
@@ -23,14 +23,24 @@ import hashlib
 import time
 import io
 
+# The fragment checksums aren't used for security, saying so keeps md5
+# available on FIPS builds of OpenSSL (MicroPython lacks the keyword)
+try:
+    hashlib.md5(b"", usedforsecurity=False)
+    MD5_KWARGS = {"usedforsecurity": False}
+except TypeError:
+    MD5_KWARGS = {}
+
 
 def open_i2c_micropython():
     import machine
 
-    # Establish the I2C bus and search for notecard
-    port = machine.SoftI2C(
+    # Establish the I2C bus on the hardware peripheral and search for notecard
+    port = machine.I2C(
+        0,
         scl=machine.Pin(22),
-        sda=machine.Pin(23)
+        sda=machine.Pin(23),
+        freq=400_000
     )
     
     devices = port.scan()
@@ -113,8 +123,12 @@ class temporary_mode():
         if self.timeout is not None:
             timeout_at = time.time() + self.timeout
         rsp = {}
+        # poll with a backoff so that a card which is slow to connect isn't
+        # kept busy answering status requests
+        delay = 1.0
+        last_status = None
         while self.wait_for_connection:
-            if timeout_at is not None and time.time() > timeout_at:
+            if timeout_at is not None and time.time() >= timeout_at:
                 raise RuntimeError("timeout waiting for continuous connection")
             req = {"req": "hub.status"}
             rsp = self.card.Transaction(req)
@@ -124,14 +138,20 @@ class temporary_mode():
             if rsp.get("connected") == True:
                 break
 
-            req = {"req": "hub.sync.status"}
-            rsp = self.card.Transaction(req)
-            logging.info("Checking sync status %s", rsp)
-            
-            time.sleep(5)
+            # the sync status is only of interest when the hub status changes
+            if rsp.get("status") != last_status:
+                last_status = rsp.get("status")
+                req = {"req": "hub.sync.status"}
+                rsp = self.card.Transaction(req)
+                logging.info("Checking sync status %s", rsp)
+
             if timeout_at is not None:
                 time_remaining = timeout_at - time.time()
                 logging.info("time remaining waiting for continuous connection %s", time_remaining)
+                time.sleep(max(0, min(delay, time_remaining)))
+            else:
+                time.sleep(delay)
+            delay = min(delay * 1.5, 60)
 
     def __exit__(self, *args, **kwargs):
         if self.current_mode != self.mode:
@@ -143,6 +163,17 @@ class temporary_mode():
             rsp = self.card.Transaction(req)
             logging.info("Restoring original mode %s response %s", self.current_mode, rsp)
 
+class held_mode():
+    """
+    Stands in for temporary_mode when the caller already holds the card in
+    the required mode
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
 from notecard import notecard as _notecard
 class temporary_segment_delay():
     """
@@ -164,35 +195,56 @@ class temporary_segment_delay():
         _notecard.CARD_REQUEST_SEGMENT_DELAY_MS = self.initial_delay_ms
 
 
-def web_post(card, route, payload, name=None, chunk_size=4096, content=None, wait_for_connection=True, connection_timeout=None):
+def web_post(card, route, payload, name=None, chunk_size=4096, content=None, wait_for_connection=True, connection_timeout=None, skip_mode=False):
+    """
+    Post payload to a Notehub route, in fragments if it is larger than
+    chunk_size. Pass skip_mode=True when the caller already holds the card
+    in continuous mode, e.g. across several posts
+    """
+    # payload may be bytes, bytearray or a memoryview, fragments are taken
+    # from a view of it so they are never copied
+    payload = memoryview(payload)
     offset = 0
     fragmented = ( len(payload) > chunk_size )
 
+    # The payload is base64 encoded once, fragments are kept to a multiple
+    # of 3 bytes so that each one's encoding is a slice of the whole
+    encoded_payload = b2a_base64( payload, newline=False )
+    if fragmented:
+        chunk_size = max(3, chunk_size - chunk_size % 3)
+
     s = time.time()
     # web.post requires continuous mode
-    with temporary_mode(card, "continuous", wait_for_connection=wait_for_connection, timeout=connection_timeout):
+    if skip_mode:
+        session = held_mode()
+    else:
+        session = temporary_mode(card, "continuous", wait_for_connection=wait_for_connection, timeout=connection_timeout)
+    # The request is built once, each fragment only replaces its payload,
+    # status and offset
+    req = {"req": "web.post"} 
+    req["route"] = route
+    if name:
+        req["name"] = name
+    if content:
+        req['content'] = content # undocumented feature
+    if fragmented:
+        req["total"] = len(payload)
+        req["verify"] = True
+
+    with session:
         # Use a faster segment delay on web.post
         with temporary_segment_delay(50):
             while offset < len(payload):
-                req = {"req": "web.post"} 
-                req["route"] = route
-                if name:
-                    req["name"] = name
-                if content:
-                    req['content'] = content # undocumented feature
-
                 if fragmented:
                     fragment = payload[offset:offset+chunk_size]
 
-                    req["total"] = len(payload)
-                    req["payload"] = b2a_base64( fragment, newline=False).decode("ascii")
-                    req["status"] = hashlib.md5( fragment ).hexdigest()
+                    req["payload"] = encoded_payload[offset // 3 * 4:(offset + chunk_size) // 3 * 4].decode("ascii")
+                    req["status"] = hashlib.md5( fragment, **MD5_KWARGS ).hexdigest()
                     req["offset"] = offset
-                    req["verify"] = True
 
                     logging.debug("sending web.post fragment of length %s at offset %s", len(fragment), offset)
                 else:
-                    req["payload"] = b2a_base64( payload, newline=False ).decode("ascii")
+                    req["payload"] = encoded_payload.decode("ascii")
                     logging.debug("sending web.post of length %s", len(payload))
 
                 offset += chunk_size
@@ -213,8 +265,29 @@ def web_post(card, route, payload, name=None, chunk_size=4096, content=None, wai
 
     return rsp, response_payload
 
+def status_transactions(card, reqs, device=None):
+    """
+    Issue each of the (argument-less) requests in reqs back to back and
+    return the responses tagged with the request, time and device
+    """
+    import datetime
+
+    responses = []
+    # The Notecard has no batch request, but a shorter segment delay keeps
+    # the round of queries from paying the full delay for each one
+    with temporary_segment_delay(50):
+        for req in reqs:
+            req = {"req": req}
+            rsp = card.Transaction(req)
+            rsp['req'] = req
+            rsp['@timestamp'] = datetime.datetime.now().isoformat()
+            rsp['device'] = device
+            responses.append(rsp)
+    return responses
+
 if __name__ == "__main__":
     import argparse
+    import contextlib
     import datetime
 
     import notecard
@@ -229,9 +302,10 @@ if __name__ == "__main__":
         I2Cc = None
 
     try:
-        from opensearchpy import OpenSearch
+        from opensearchpy import OpenSearch, helpers
     except ImportError:
         OpenSearch = None
+        helpers = None
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--notecard-port", default="/dev/i2c-1")
@@ -270,8 +344,9 @@ if __name__ == "__main__":
     device = rsp.get("device")
 
     synccount = 0
+    post_session = None
     while True:
-        for action in args.action:
+        for ii, action in enumerate(args.action):
             logging.info("-------------- Action %s --------------", action)
 
             if action.startswith("pause"):
@@ -281,45 +356,12 @@ if __name__ == "__main__":
                 # wait for the notecard to become connected
                 rsp = {}
                 while True:
-                    responses = []
-
-                    req = {"req": "hub.sync"}
-                    rsp = nCard.Transaction(req)
-                    rsp['req'] = req
-                    rsp['@timestamp'] = datetime.datetime.now().isoformat()
-                    rsp['device'] = device
-                    responses.append(rsp)
-
-                    req = {"req": "hub.status"}
-                    rsp = nCard.Transaction(req)
-                    rsp['req'] = req
-                    rsp['@timestamp'] = datetime.datetime.now().isoformat()
-                    rsp['device'] = device
-                    responses.append(rsp)
-
-                    connected = rsp.get("connected")
-   
-                    req = {"req": "hub.sync.status"}
-                    rsp = nCard.Transaction(req)
-                    rsp['req'] = req
-                    rsp['@timestamp'] = datetime.datetime.now().isoformat()
-                    rsp['device'] = device
-                    responses.append(rsp)
-
-                    req = {"req": "card.wireless"}
-                    rsp = nCard.Transaction(req)
-                    rsp['req'] = req
-                    rsp['@timestamp'] = datetime.datetime.now().isoformat()
-                    rsp['device'] = device
-                    responses.append(rsp)
+                    responses = status_transactions(nCard, ["hub.sync", "hub.status", "hub.sync.status", "card.wireless"], device)
+                    connected = responses[1].get("connected")
 
                     if db is not None:
-                        for rsp in responses:
-                            
-                            db.index(
-                                index = "notecard",
-                                body = rsp,
-                            )
+                        # one bulk request per poll rather than one request per response
+                        helpers.bulk(db, ({"_index": "notecard", "_source": rsp} for rsp in responses))
                    
                     if connected == True:
                         break
@@ -327,36 +369,10 @@ if __name__ == "__main__":
                     time.sleep(args.poll)
 
             elif action == "monitor":
-                responses = []
-
-                req = {"req": "hub.status"}
-                rsp = nCard.Transaction(req)
-                rsp['req'] = req
-                rsp['@timestamp'] = datetime.datetime.now().isoformat()
-                rsp['device'] = device
-                responses.append(rsp)
-
-                req = {"req": "hub.sync.status"}
-                rsp = nCard.Transaction(req)
-                rsp['req'] = req
-                rsp['@timestamp'] = datetime.datetime.now().isoformat()
-                rsp['device'] = device
-                responses.append(rsp)
-
-                req = {"req": "card.wireless"}
-                rsp = nCard.Transaction(req)
-                rsp['req'] = req
-                rsp['@timestamp'] = datetime.datetime.now().isoformat()
-                rsp['device'] = device
-                responses.append(rsp)
+                responses = status_transactions(nCard, ["hub.status", "hub.sync.status", "card.wireless"], device)
 
                 if db is not None:
-                    for rsp in responses:
-                        
-                        db.index(
-                            index = "notecard",
-                            body = rsp,
-                        )
+                    helpers.bulk(db, ({"_index": "notecard", "_source": rsp} for rsp in responses))
 
                 time.sleep(args.poll)
 
@@ -405,14 +421,30 @@ if __name__ == "__main__":
                 rsp = nCard.Transaction(req)
 
             elif action.startswith("post:"):
-                _, route, data = action.split(":", 2)
-                if data[0] == "@":
-                    logging.debug("Loading content from %s", data[1:])
-                    fpath = data[1:]
-                    with open(fpath, 'rb') as ff:
-                        dd = ff.read()
-                        rsp = web_post(nCard, route, dd, wait_for_connection=not args.no_wait_for_connection)
+                # consecutive posts share one continuous mode session
+                if post_session is None:
+                    post_session = contextlib.ExitStack()
+                    post_session.enter_context(
+                        temporary_mode(nCard, "continuous", wait_for_connection=not args.no_wait_for_connection)
+                    )
+
+                try:
+                    _, route, data = action.split(":", 2)
+                    if data[0] == "@":
+                        logging.debug("Loading content from %s", data[1:])
+                        fpath = data[1:]
+                        with open(fpath, 'rb') as ff:
+                            dd = ff.read()
+                            rsp = web_post(nCard, route, dd, skip_mode=True)
+                            print(rsp)
+                    else:
+                        rsp = web_post(nCard, route, data.encode("ascii"), skip_mode=True)
                         print(rsp)
-                else:
-                    rsp = web_post(nCard, route, data.encode("ascii"), wait_for_connection=not args.no_wait_for_connection)
-                    print(rsp)
\ No newline at end of file
+                except:
+                    # restore the original mode before the error propagates
+                    post_session.close()
+                    raise
+
+                if ii + 1 == len(args.action) or not args.action[ii + 1].startswith("post:"):
+                    post_session.close()
+                    post_session = None
\ No newline at end of file
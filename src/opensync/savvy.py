@@ -44,7 +44,7 @@ def publish_flight_log_direct(token, aircraft_id, fname, log):
             'token': token,
             # plain file object, no filename or mime type produces a
             # Content-Disposition header with just the part name
-            'file': (fname, io.StringIO(log), 'text/plain'),
+            'file': (fname, log, 'text/plain'),
         }
     )
 
@@ -54,11 +54,12 @@ def publish_flight_log_direct(token, aircraft_id, fname, log):
         # The MultipartEncoder provides the content-type header with the boundary:
         headers={'Content-Type': mp_encoder.content_type}
     )
-    print(r)
-    print(mp_encoder.content_type)
-    print(r.text)
+    if r.status_code != 200:
+        logging.warning("Error posting to SavvyAnalysis %s:  %s", r, r.text)
+    else:
+        logging.debug("SavvyAnalysis response %s", r.text)
 
-def publish_flight_log_notecard(card, token, aircraft_id, fname, log, chunk_size=8192):
+def publish_flight_log_notecard(card, token, aircraft_id, fname, log, chunk_size=8192, skip_mode=False):
     mp_encoder = MultipartEncoder(
         fields={
             'token': token,
@@ -70,8 +71,15 @@ def publish_flight_log_notecard(card, token, aircraft_id, fname, log, chunk_size
 
     payload = mp_encoder.to_string()
 
+    # the caller may already hold the card in continuous mode across several
+    # uploads
+    if skip_mode:
+        session = notecard_helpers.held_mode()
+    else:
+        session = notecard_helpers.temporary_mode(card, "continuous", timeout=120)
+
     try:
-        with notecard_helpers.temporary_mode(card, "continuous", timeout=120):
+        with session:
             try:
                 rsp, response_payload = notecard_helpers.web_post(
                     card,
@@ -80,7 +88,7 @@ def publish_flight_log_notecard(card, token, aircraft_id, fname, log, chunk_size
                     name=f"{aircraft_id}/",
                     chunk_size=chunk_size,
                     content=mp_encoder.content_type,
-                    connection_timeout=30
+                    skip_mode=True
                 )
             except:
                 logging.exception("error publishing to savvy aviation")
@@ -130,15 +138,22 @@ if __name__ == "__main__":
         rsp = nCard.Transaction(req)
         logging.info("Found notecard %s", rsp)
 
+    # uploads through the notecard share one continuous mode session
+    if nCard:
+        session = notecard_helpers.temporary_mode(nCard, "continuous", timeout=120)
+    else:
+        session = notecard_helpers.held_mode()
+
+    with session:
         for f in args.files:
-            with open(f, 'r', errors='ignore') as log:
+            with open(f, 'rb') as log:
                 fname = os.path.basename(f)
                 if args.savvy_aviation_mode == "native":
                     publish_flight_log_direct(
                         args.savvy_aviation_token,
                         args.savvy_aviation_aircraft_id,
                         fname,
-                        log.read()
+                        log
                     )
                 else:
                     publish_flight_log_notecard(
@@ -146,5 +161,6 @@ if __name__ == "__main__":
                         args.savvy_aviation_token,
                         args.savvy_aviation_aircraft_id,
                         fname,
-                        log.read()
+                        log,
+                        skip_mode=True
                     )
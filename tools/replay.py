@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import itertools
 import sys
 import time
 infile = sys.argv[1]
@@ -9,16 +10,21 @@ try:
 except IndexError:
     rate_hz = 1
 
-with open(infile) as ff:
-    lines = ff.readlines()
-
-with open(oufile, "w") as ff:
+with open(infile) as ff_in, open(oufile, "w") as ff:
     # write the first 3 lines immediately
-    for ll in lines[0:3]:
+    for ll in itertools.islice(ff_in, 3):
         ff.write(ll)
-    # write the remaining lines at specified rate
-    for ll in lines[3:]:
+    ff.flush()
+    # write the remaining lines at specified rate, sleeping until each
+    # line's deadline so that the rate doesn't drift, and flushing about
+    # ten times a second
+    period = 1.0 / rate_hz
+    flush_every = max(1, rate_hz // 10)
+    t0 = time.monotonic()
+    for ii, ll in enumerate(ff_in, 1):
         ff.write(ll)
-        time.sleep(1.0 / rate_hz)
-        ff.flush()
-    
\ No newline at end of file
+        slack = t0 + ii * period - time.monotonic()
+        if slack > 0:
+            time.sleep(slack)
+        if ii % flush_every == 0:
+            ff.flush()